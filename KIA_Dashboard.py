@@ -1,5 +1,6 @@
 #!/usr/bin/python3
 
+import logging
 from threading import Thread
 
 import dash
@@ -7,23 +8,27 @@ from dash import dcc, html
 from flask import Flask
 
 import globals
-from calendar_widget_component import (
-    calendar_background_scheduler,
-    get_calendar_layout,
-    register_calendar_callbacks,
-)
+from calendar_widget_component import get_calendar_layout, register_calendar_callbacks
+from climate_scheduler import calendar_background_scheduler
+from history_widget_component import get_history_layout, register_history_callbacks
+from http_tuning import configure_compression, register_cache_headers
+from live_refresh import register_refresh_routes
 from main_widget_components import get_main_layout, register_main_callbacks
+from metrics import register_metrics_route
+from push_channel import register_push_routes
 from rest_updater import rest_updater
 
+logging.basicConfig(level=globals.LOG_LEVEL, format=globals.LOG_FORMAT)
+
 server = Flask(__name__)
 
 ############################## Create Dash app ##############################
-external_stylesheets = ['https://codepen.io/chriddyp/pen/bWLwgP.css']
+# The stylesheet is served from assets/, no external requests needed
 app = dash.Dash(
     __name__,
     server=server,
     url_base_pathname='/',
-    external_stylesheets=external_stylesheets,
+    compress=configure_compression(server),
     prevent_initial_callbacks='initial_duplicate',
 )
 app.title = f'{globals.LICENSE_PLATE} car status'
@@ -38,18 +43,31 @@ app.layout = html.Div(
     [
         dcc.Tabs(
             [
-                dcc.Tab(label='Home', children=[get_main_layout(prefix='main')]),
+                dcc.Tab(label='Home', value='home', children=[get_main_layout(prefix='main')]),
                 dcc.Tab(
                     label='Climate Control Schedule',
+                    value='calendar',
                     children=[get_calendar_layout(prefix='calendar')],
                 ),
-            ]
+                dcc.Tab(
+                    label='History',
+                    value='history',
+                    children=[get_history_layout(prefix='history')],
+                ),
+            ],
+            id='tabs',
+            value='home',
         )
     ]
 )
 
 register_main_callbacks(app, prefix='main')
 register_calendar_callbacks(app, prefix='calendar')
+register_history_callbacks(app, prefix='history', tabs_id='tabs', tab_value='history')
+register_push_routes(server)
+register_refresh_routes(server)
+register_cache_headers(app)
+register_metrics_route(app)
 
 
 ############################## Create Flask app ##############################
@@ -58,10 +76,15 @@ def my_dash_app():
     return app.index()
 
 
-if __name__ == '__main__':
+def start_background_threads():
+    # Polls the vehicles and fires scheduled climate slots. Must run in one process only.
     rest_thread = Thread(target=rest_updater, daemon=True)
     rest_thread.start()
     calendar_thread = Thread(target=calendar_background_scheduler, daemon=True)
     calendar_thread.start()
 
+
+if __name__ == '__main__':
+    start_background_threads()
+
     server.run(host='0.0.0.0', port=8080, threaded=True, debug=False)
@@ -0,0 +1,103 @@
+#!/usr/bin/python3
+# Dashboard refresh callbacks per second with N concurrent clients.
+#
+#   python3 benchmarks/callback_throughput.py --clients 1 8 32 --seconds 10
+#
+# Every client posts the refresh callback in a loop, like an open tab on its interval. In
+# 'full' mode the client claims to have rendered nothing yet, so every response carries
+# all widget values and the map figure. In 'unchanged' mode it sends what the previous
+# response rendered, which is the common case for a tab that is already up to date.
+
+import argparse
+import http.client
+import json
+import time
+from threading import Thread
+from urllib.parse import urlparse
+
+from common import serve_app, summary
+
+REFRESH_OUTPUT = 'main-map.figure'
+
+
+def refresh_request(deps):
+    for dep in deps:
+        if REFRESH_OUTPUT in dep['output'] and '@' not in dep['output']:
+            break
+    else:
+        raise KeyError(REFRESH_OUTPUT)
+    outputs = []
+    for output in dep['output'].strip('.').split('...'):
+        component_id, prop = output.rsplit('.', 1)
+        outputs.append({'id': component_id, 'property': prop})
+    return {
+        'output': dep['output'],
+        'outputs': outputs,
+        'inputs': [
+            {'id': 'main-interval-component', 'property': 'n_intervals', 'value': 1},
+            {'id': 'main-vehicle-select', 'property': 'value', 'value': None},
+        ],
+        'changedPropIds': ['main-interval-component.n_intervals'],
+        'state': [{'id': 'main-rendered-store', 'property': 'data', 'value': None}],
+    }
+
+
+def client(base_url, body, mode, deadline, latencies):
+    url = urlparse(base_url)
+    conn = http.client.HTTPConnection(url.hostname, url.port, timeout=30)
+    body = json.loads(json.dumps(body))
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        conn.request(
+            'POST', '/_dash-update-component', json.dumps(body), {'Content-Type': 'application/json'}
+        )
+        response = conn.getresponse()
+        data = response.read()
+        latencies.append(time.perf_counter() - start)
+        if response.getheader('Connection', '').lower() == 'close' or response.version == 10:
+            conn.close()
+            conn = http.client.HTTPConnection(url.hostname, url.port, timeout=30)
+        if mode == 'unchanged' and response.status == 200:
+            rendered = json.loads(data)['response']['main-rendered-store']['data']
+            body['state'][0]['value'] = rendered
+    conn.close()
+
+
+def run(base_url, body, clients, seconds, mode):
+    latencies = [[] for _ in range(clients)]
+    deadline = time.perf_counter() + seconds
+    threads = [
+        Thread(target=client, args=(base_url, body, mode, deadline, latencies[i]))
+        for i in range(clients)
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    samples = [latency for client_latencies in latencies for latency in client_latencies]
+    print(f'{len(samples) / elapsed:8.1f} req/s  ' + summary(f'{clients} clients, {mode}', samples))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure refresh callback throughput')
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--mode', choices=['full', 'unchanged', 'both'], default='both')
+    args = parser.parse_args()
+
+    base_url = serve_app()
+    url = urlparse(base_url)
+    conn = http.client.HTTPConnection(url.hostname, url.port)
+    conn.request('GET', '/_dash-dependencies')
+    body = refresh_request(json.loads(conn.getresponse().read()))
+    conn.close()
+    modes = ['full', 'unchanged'] if args.mode == 'both' else [args.mode]
+    for mode in modes:
+        for clients in args.clients:
+            run(base_url, body, clients, args.seconds, mode)
+
+
+if __name__ == '__main__':
+    main()
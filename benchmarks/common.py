@@ -0,0 +1,53 @@
+# Shared setup of the benchmarks: runs the dashboard against the fake vehicle backend and
+# a fake InfluxDB, with all state files in a temporary directory. Import this module
+# before anything from the dashboard itself.
+
+import os
+import statistics
+import sys
+import tempfile
+from threading import Thread
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from fake_influx import start_fake_influx  # noqa: E402
+
+STATE_DIR = tempfile.mkdtemp(prefix='kia-bench-')
+fake_influx = start_fake_influx()
+
+os.environ.setdefault('VEHICLE_BACKEND', 'fake')
+os.environ.setdefault('FAKE_LATENCY', '0.05')
+os.environ.setdefault('FAKE_LATENCY_JITTER', '0.01')
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+os.environ['INFLUXDB_URL'] = fake_influx.url
+os.environ['SCHEDULE_FILE'] = os.path.join(STATE_DIR, 'scheduled_slots.json')
+os.environ['STATE_CACHE_FILE'] = os.path.join(STATE_DIR, 'state_cache.json')
+os.environ['INFLUX_SPOOL_FILE'] = os.path.join(STATE_DIR, 'influx_spool.lp')
+
+
+def serve_app(port=0):
+    # Runs the Flask server of the dashboard in a background thread, returns its base url
+    import logging
+
+    from werkzeug.serving import make_server
+
+    import KIA_Dashboard
+
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+    httpd = make_server('127.0.0.1', port, KIA_Dashboard.server, threaded=True)
+    Thread(target=httpd.serve_forever, name='bench-server', daemon=True).start()
+    return f'http://127.0.0.1:{httpd.server_port}'
+
+
+def summary(label, seconds):
+    # One line with the count, median, p95 and max of a list of durations
+    seconds = sorted(seconds)
+    if not seconds:
+        return f'{label}: no samples'
+    p95 = seconds[min(len(seconds) - 1, int(len(seconds) * 0.95))]
+    return (
+        f'{label}: n={len(seconds)} median={statistics.median(seconds) * 1000:.1f} ms '
+        f'p95={p95 * 1000:.1f} ms max={seconds[-1] * 1000:.1f} ms'
+    )
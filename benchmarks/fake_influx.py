@@ -0,0 +1,81 @@
+#!/usr/bin/python3
+# Local InfluxDB stand-in that accepts line protocol writes and counts them.
+#
+#   python3 benchmarks/fake_influx.py --port 8086 --latency 0.05 --failure-rate 0.1
+
+import argparse
+import random
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+
+
+class FakeInflux(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.0, failure_rate=0.0):
+        super().__init__(address, FakeInfluxHandler)
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.lock = Lock()
+        self.writes = 0
+        self.lines = []
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        Thread(target=self.serve_forever, name='fake-influx', daemon=True).start()
+        return self
+
+
+class FakeInfluxHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body=b''):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        # /ping and /health
+        self.reply(204 if self.path.startswith('/ping') else 200, b'{"status": "pass"}')
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if not self.path.startswith('/api/v2/write'):
+            self.reply(404)
+            return
+        server = self.server
+        time.sleep(server.latency)
+        if random.random() < server.failure_rate:
+            self.reply(503, b'{"code": "unavailable", "message": "simulated failure"}')
+            return
+        if self.headers.get('Content-Encoding') == 'gzip':
+            import gzip
+
+            body = gzip.decompress(body)
+        lines = [line for line in body.decode().splitlines() if line]
+        with server.lock:
+            server.writes += 1
+            server.lines.extend(lines)
+        self.reply(204)
+
+
+def start_fake_influx(port=0, latency=0.0, failure_rate=0.0):
+    return FakeInflux(('127.0.0.1', port), latency, failure_rate).start()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local InfluxDB stand-in')
+    parser.add_argument('--port', type=int, default=8086)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--failure-rate', type=float, default=0.0)
+    args = parser.parse_args()
+    server = FakeInflux(('0.0.0.0', args.port), args.latency, args.failure_rate)
+    print(f'Fake InfluxDB listening on port {args.port}')
+    server.serve_forever()
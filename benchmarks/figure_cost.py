@@ -0,0 +1,48 @@
+#!/usr/bin/python3
+# Cost of rendering the climate calendar against the number of scheduled slots.
+#
+#   python3 benchmarks/figure_cost.py --sizes 0 10 100 476 1000
+
+import argparse
+import random
+import time
+
+from common import summary
+from calendar_widget_component import make_figure, update_figure
+from schedule_grid import DAYS, TIME_SLOTS
+
+TIMEZONES = ['Europe/Amsterdam', 'Europe/London', 'America/New_York', 'Asia/Tokyo', 'UTC']
+
+
+def random_slots(count, timezones, rng):
+    candidates = [(d, t, tz) for tz in timezones for d in DAYS for t in TIME_SLOTS]
+    return rng.sample(candidates, min(count, len(candidates)))
+
+
+def measure(fn, repeat):
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure calendar figure cost')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[0, 10, 100, 476, 1000])
+    parser.add_argument('--timezones', type=int, default=3, help='Timezones the slots are spread over')
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    timezones = TIMEZONES[: args.timezones]
+    viewer = 'Europe/Amsterdam'
+    for size in args.sizes:
+        slots = frozenset(random_slots(size, timezones, rng))
+        print(summary(f'make_figure   {len(slots):5d} slots', measure(lambda: make_figure(slots, 'calendar', viewer), args.repeat)))
+        print(summary(f'update_figure {len(slots):5d} slots', measure(lambda: update_figure(slots, viewer), args.repeat)))
+
+
+if __name__ == '__main__':
+    main()
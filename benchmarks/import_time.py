@@ -0,0 +1,61 @@
+#!/usr/bin/python3
+# Measures how long importing the dashboard takes, i.e. how long a restarted container
+# needs before it can bind its port. Exits with status 1 when the median run is over budget.
+#
+#   python3 benchmarks/import_time.py --runs 5 --budget 1.5
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_times(module):
+    # Cumulative import time in seconds per module, from `python -X importtime`
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=REPO_DIR,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:') :].split('|')
+        name = name.rstrip()
+        depth = (len(name) - len(name.lstrip())) // 2
+        times.setdefault(name.strip(), (int(cumulative) / 1e6, depth))
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the dashboard import time')
+    parser.add_argument('--module', default='KIA_Dashboard')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--budget', type=float, default=float(os.getenv('IMPORT_TIME_BUDGET', '1.5')))
+    parser.add_argument('--top', type=int, default=15)
+    args = parser.parse_args()
+
+    runs = [import_times(args.module) for _ in range(args.runs)]
+    totals = [run[args.module][0] for run in runs]
+    # Modules imported directly by the entry point and its own modules, by median time
+    names = {name for name, (_, depth) in runs[0].items() if depth <= 1}
+    medians = {
+        name: statistics.median(run[name][0] for run in runs if name in run) for name in names
+    }
+    for name, seconds in sorted(medians.items(), key=lambda item: -item[1])[: args.top]:
+        print(f'{seconds * 1000:8.1f} ms  {name}')
+    median = statistics.median(totals)
+    print(f'import {args.module}: median {median:.3f} s over {args.runs} runs, budget {args.budget:.3f} s')
+    if median > args.budget:
+        print('Import time is over budget')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
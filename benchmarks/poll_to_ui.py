@@ -0,0 +1,56 @@
+#!/usr/bin/python3
+# End to end latency from requesting a poll to the new values reaching a dashboard tab
+# over the Server-Sent Events stream, with the fake vehicle backend.
+#
+#   FAKE_LATENCY=0.3 python3 benchmarks/poll_to_ui.py --polls 20
+
+import argparse
+import http.client
+import time
+from threading import Thread
+from urllib.parse import urlparse
+
+from common import serve_app, summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure poll to dashboard latency')
+    parser.add_argument('--polls', type=int, default=10)
+    args = parser.parse_args()
+
+    from poll_scheduler import poll_scheduler
+    from rest_updater import rest_updater
+
+    base_url = urlparse(serve_app())
+    # The updater gets a poll request for every measurement, nothing else
+    poll_scheduler.idle = poll_scheduler.active = poll_scheduler.maximum = 24 * 60 * 60
+    Thread(target=rest_updater, daemon=True).start()
+
+    conn = http.client.HTTPConnection(base_url.hostname, base_url.port, timeout=60)
+    conn.request('GET', '/api/stream')
+    stream = conn.getresponse()
+
+    def next_event():
+        # Skips keep-alive comments, returns when a data event arrived
+        while True:
+            line = stream.fp.readline()
+            if not line:
+                raise EOFError('stream closed')
+            if line.startswith(b'data:'):
+                stream.fp.readline()
+                return
+
+    next_event()  # current values
+    next_event()  # first poll after startup
+    latencies = []
+    for _ in range(args.polls):
+        start = time.perf_counter()
+        poll_scheduler.request_poll(0)
+        next_event()
+        latencies.append(time.perf_counter() - start)
+    print(summary('poll to UI', latencies))
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
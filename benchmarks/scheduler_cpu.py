@@ -0,0 +1,53 @@
+#!/usr/bin/python3
+# CPU used by the climate scheduler: planning a schedule, and the background thread
+# idling on a large schedule.
+#
+#   python3 benchmarks/scheduler_cpu.py --sizes 10 100 1000 --seconds 10
+
+import argparse
+import random
+import time
+from datetime import datetime
+from threading import Thread
+
+import pytz
+
+from common import summary
+from figure_cost import TIMEZONES, measure, random_slots
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure climate scheduler CPU use')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--timezones', type=int, default=3)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--seconds', type=float, default=10, help='How long to run the scheduler thread')
+    args = parser.parse_args()
+
+    import climate_scheduler
+    from schedule_store import schedule_store
+
+    rng = random.Random(1)
+    timezones = TIMEZONES[: args.timezones]
+    for size in args.sizes:
+        slots = frozenset(random_slots(size, timezones, rng))
+        now = datetime.now(pytz.UTC)
+        print(summary(f'plan_schedule {len(slots):5d} slots', measure(lambda: climate_scheduler.plan_schedule(slots, now, {}), args.repeat)))
+
+    # The thread normally sleeps until the next slot; edits replan, so toggle one slot
+    # every second to include the replanning cost
+    schedule_store.set_slots(random_slots(max(args.sizes), timezones, rng))
+    Thread(target=climate_scheduler.calendar_background_scheduler, daemon=True).start()
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    extra = ('Monday', '06:00', 'UTC')
+    while time.perf_counter() - wall_start < args.seconds:
+        schedule_store.toggle(extra)
+        time.sleep(1)
+    cpu = time.process_time() - cpu_start
+    wall = time.perf_counter() - wall_start
+    print(f'scheduler thread with {max(args.sizes)} slots: {cpu:.3f} s CPU in {wall:.1f} s ({100 * cpu / wall:.2f}% of a core)')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,133 +1,132 @@
-import json
-import os
-from datetime import datetime, timedelta
-import pytz
-import plotly.graph_objs as go
-from dash import callback_context, Input, Output, State, dcc, html
-from hyundai_kia_connect_api import ClimateRequestOptions
-import time as time_mod
+import logging
+from datetime import datetime, timezone
+from functools import lru_cache
+from dash import callback_context, no_update, Input, Output, Patch, State, dcc, html
 
-import globals
+from climate_profiles import DEFAULT_PROFILE
+from schedule_grid import DAY_INDEX, DAYS, TIME_INDEX, TIME_SLOTS, parse_template
+from schedule_store import schedule_store
+from slot_time import iso_week, label_minutes, project_slots, slot_utc_minute, viewer_local
 
-DAYS = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
-START_HOUR = 6
-END_HOUR = 23
-SLOT_MINUTES = 15
-SCHEDULE_FILE = 'scheduled_slots.json'
+MINUTE_INDEX = {label_minutes(t): i for i, t in enumerate(TIME_SLOTS)}
 
+logger = logging.getLogger(__name__)
 
-def generate_time_slots(start_hour, end_hour, slot_minutes):
-    slots = []
-    t = datetime(2000, 1, 1, start_hour, 0)
-    end = datetime(2000, 1, 1, end_hour, 0)
-    while t < end:
-        slots.append(t.strftime('%H:%M'))
-        t += timedelta(minutes=slot_minutes)
-    return slots
+def occupancy_grid(scheduled_slots, timezone_store=None):
+    user_timezone = timezone_store if timezone_store else 'UTC'
+    # Slots are projected as they occur this week, so the current DST rules apply
+    week = iso_week(datetime.now(timezone.utc).date())
+    rows = []
+    cols = []
+    for day_idx, minute in project_slots(scheduled_slots, user_timezone, week):
+        time_idx = MINUTE_INDEX.get(minute)
+        # Slots that fall outside the displayed hours are not drawn
+        if time_idx is not None:
+            rows.append(time_idx)
+            cols.append(day_idx)
+    import numpy as np
 
+    z = np.zeros((len(TIME_SLOTS), len(DAYS)), dtype=np.uint8)
+    z[rows, cols] = 1
+    return z.tolist()
 
-TIME_SLOTS = generate_time_slots(START_HOUR, END_HOUR, SLOT_MINUTES)
 
+def viewer_cells(scheduled_slots, user_timezone):
+    # (day index, time index) -> stored slots shown in that cell for this viewer
+    week = iso_week(datetime.now(timezone.utc).date())
+    cells = {}
+    for slot in scheduled_slots:
+        utc_minute = slot_utc_minute(slot, week)
+        if utc_minute is None:
+            continue
+        day_idx, minute = viewer_local(utc_minute, user_timezone)
+        time_idx = MINUTE_INDEX.get(minute)
+        if time_idx is not None:
+            cells.setdefault((day_idx, time_idx), []).append(slot)
+    return cells
 
-def load_schedule():
-    if os.path.exists(SCHEDULE_FILE):
-        with open(SCHEDULE_FILE, 'r') as f:
-            try:
-                return json.load(f)
-            except Exception:
-                return []
-    return []
 
+def axis_index(value, index, size):
+    # Category axes report either the category or its (fractional) position
+    if isinstance(value, str):
+        return index.get(value)
+    return min(max(int(round(value)), 0), size - 1)
 
-def save_schedule(slots):
-    with open(SCHEDULE_FILE, 'w') as f:
-        json.dump(slots, f)
 
+def selected_cells(selected_data):
+    # Grid cells inside a box or lasso selection
+    n_days = len(DAYS)
+    n_times = len(TIME_SLOTS)
+    if selected_data.get('range'):
+        xs = [axis_index(v, DAY_INDEX, n_days) for v in selected_data['range']['x']]
+        ys = [axis_index(v, TIME_INDEX, n_times) for v in selected_data['range']['y']]
+        if None in xs or None in ys:
+            return set()
+        return {
+            (day, t)
+            for day in range(min(xs), max(xs) + 1)
+            for t in range(min(ys), max(ys) + 1)
+        }
+    lasso = selected_data.get('lassoPoints')
+    if not lasso:
+        return set()
+    polygon = []
+    for x, y in zip(lasso['x'], lasso['y']):
+        if isinstance(x, str):
+            x = DAY_INDEX.get(x)
+        if isinstance(y, str):
+            y = TIME_INDEX.get(y)
+        if x is not None and y is not None:
+            polygon.append((x, y))
+    return {
+        (day, t)
+        for day in range(n_days)
+        for t in range(n_times)
+        if inside(day, t, polygon)
+    }
 
-def make_figure(scheduled_slots, prefix, timezone_store=None):
-    z = []
-    tz_store = timezone_store if timezone_store else 'UTC'
-    user_timezone = tz_store if tz_store else 'UTC'
-    tz = pytz.timezone(user_timezone)
-    # Convert all slots to user's local time for display
-    display_slots = []
-    for slot in scheduled_slots:
-        if len(slot) == 3:
-            day, time_label, slot_tz = slot
-            slot_tz_obj = pytz.timezone(slot_tz)
-            # Find the weekday index for the scheduled day
-            try:
-                day_idx = DAYS.index(day)
-            except ValueError:
-                day_idx = 0
-            # Use a reference Monday of this week, then add day_idx days
-            now = datetime.now()
-            ref_monday = now - timedelta(days=now.weekday())
-            slot_date = ref_monday + timedelta(days=day_idx)
-            slot_local = slot_tz_obj.localize(datetime(slot_date.year, slot_date.month, slot_date.day, int(time_label[:2]), int(time_label[3:]), 0, 0))
-            slot_user = slot_local.astimezone(tz)
-            # Use the user's local weekday and time
-            display_slots.append((slot_user.strftime('%A'), slot_user.strftime('%H:%M')))
-        else:
-            display_slots.append((slot[0], slot[1]))
-    for t in TIME_SLOTS:
-        row = []
-        for d in DAYS:
-            row.append(1 if any(ds[0] == d and ds[1] == t for ds in display_slots) else 0)
-        z.append(row)
-    fig = go.Figure(
-        data=go.Heatmap(
-            z=z,
-            x=DAYS,
-            y=TIME_SLOTS,
-            colorscale=[[0, 'white'], [1, 'lightblue']],
-            showscale=False,
-            hoverongaps=False,
-        )
-    )
-    # Add grid lines as shapes
-    shapes = []
+
+def inside(x, y, polygon):
+    # Even-odd rule point in polygon test
+    result = False
+    for (x1, y1), (x2, y2) in zip(polygon, polygon[-1:] + polygon[:-1]):
+        if (y1 > y) != (y2 > y) and x < (x2 - x1) * (y - y1) / (y2 - y1) + x1:
+            result = not result
+    return result
+
+
+def edit_cells(cells, schedule, user_timezone, profile=DEFAULT_PROFILE):
+    # Schedules the cells in the viewer's timezone with a climate profile, or unschedules
+    # whatever is shown in them, as a single store update. Returns the number of changed slots.
+    if schedule:
+        add = [(DAYS[day], TIME_SLOTS[t], user_timezone) for day, t in cells]
+        return schedule_store.update(add=add, profile=profile)
+    shown = viewer_cells(schedule_store.slots(), user_timezone)
+    remove = [slot for cell in cells for slot in shown.get(cell, ())]
+    return schedule_store.update(remove=remove)
+
+
+@lru_cache(maxsize=1)
+def figure_layout():
+    # Static axes and grid lines, shared by every figure. Callers must not mutate it.
     n_cols = len(DAYS)
     n_rows = len(TIME_SLOTS)
-    for i in range(n_cols + 1):
-        x0 = i - 0.5
-        x1 = i - 0.5
-        shapes.append(
-            dict(
-                type='line',
-                xref='x',
-                yref='paper',
-                x0=x0,
-                y0=0,
-                x1=x1,
-                y1=1,
-                line=dict(color='black', width=1),
-            )
-        )
-    for j in range(n_rows + 1):
-        y0 = j - 0.5
-        y1 = j - 0.5
-        shapes.append(
-            dict(
-                type='line',
-                xref='paper',
-                yref='y',
-                x0=0,
-                y0=y0,
-                x1=1,
-                y1=y1,
-                line=dict(color='black', width=1),
-            )
-        )
-    fig.update_layout(
-        title='Click a timeslot to schedule climate control',
-        xaxis_title='',
-        yaxis_title='Time',
+    line = dict(color='black', width=1)
+    shapes = [
+        dict(type='line', xref='x', yref='paper', x0=i - 0.5, y0=0, x1=i - 0.5, y1=1, line=line)
+        for i in range(n_cols + 1)
+    ] + [
+        dict(type='line', xref='paper', yref='y', x0=0, y0=j - 0.5, x1=1, y1=j - 0.5, line=line)
+        for j in range(n_rows + 1)
+    ]
+    return dict(
+        title=dict(text='Click a timeslot or drag over a range to schedule climate control'),
         margin=dict(l=40, r=40, t=40, b=40),
         clickmode='event+select',
-        yaxis_autorange='reversed',
+        dragmode='select',
         height=1200,
         xaxis=dict(
+            title=dict(text=''),
             tickmode='array',
             tickvals=DAYS,
             ticktext=[f'<b>{d}</b>' for d in DAYS],
@@ -139,6 +138,8 @@ def make_figure(scheduled_slots, prefix, timezone_store=None):
             fixedrange=True,
         ),
         yaxis=dict(
+            title=dict(text='Time'),
+            autorange='reversed',
             tickmode='array',
             tickvals=TIME_SLOTS,
             showgrid=False,
@@ -150,15 +151,76 @@ def make_figure(scheduled_slots, prefix, timezone_store=None):
         ),
         shapes=shapes,
     )
-    return fig
+
+
+def make_figure(scheduled_slots, prefix, timezone_store=None):
+    return dict(
+        data=[
+            dict(
+                type='heatmap',
+                z=occupancy_grid(scheduled_slots, timezone_store),
+                x=DAYS,
+                y=TIME_SLOTS,
+                colorscale=[[0, 'white'], [1, 'lightblue']],
+                showscale=False,
+                hoverongaps=False,
+            )
+        ],
+        layout=figure_layout(),
+    )
+
+
+def update_figure(scheduled_slots, timezone_store=None):
+    # Partial update for a figure already shown by the client: only the heatmap data changes,
+    # and a range selection that has been applied is cleared
+    patch = Patch()
+    patch['data'][0]['z'] = occupancy_grid(scheduled_slots, timezone_store)
+    patch['layout']['selections'] = []
+    return patch
 
 
 def get_calendar_layout(prefix='calendar'):
     return html.Div(
         [
             dcc.Location(id=f'{prefix}-url', refresh=False),
-            dcc.Graph(id=f'{prefix}-graph', config={'displayModeBar': False}),
-            dcc.Store(id=f'{prefix}-scheduled-slots'),
+            html.Div(
+                [
+                    dcc.RadioItems(
+                        id=f'{prefix}-mode',
+                        options=[
+                            {'label': 'Schedule', 'value': 'schedule'},
+                            {'label': 'Unschedule', 'value': 'unschedule'},
+                        ],
+                        value='schedule',
+                        inline=True,
+                        style={'display': 'inline-block', 'marginRight': 20},
+                    ),
+                    dcc.Dropdown(
+                        id=f'{prefix}-profile',
+                        options=[{'label': name, 'value': name} for name in schedule_store.profiles()],
+                        value=DEFAULT_PROFILE,
+                        clearable=False,
+                        style={'display': 'inline-block', 'width': 150, 'verticalAlign': 'middle'},
+                    ),
+                    dcc.Input(
+                        id=f'{prefix}-template',
+                        type='text',
+                        placeholder='weekdays 07:30, sat,sun 09:00-10:00',
+                        debounce=True,
+                        style={'display': 'inline-block', 'width': 300},
+                    ),
+                    html.Button(
+                        'Apply', id=f'{prefix}-template-button', style={'display': 'inline-block'}
+                    ),
+                ]
+            ),
+            dcc.Graph(
+                id=f'{prefix}-graph',
+                config={
+                    'displaylogo': False,
+                    'modeBarButtons': [['select2d', 'lasso2d']],
+                },
+            ),
             dcc.Store(id=f'{prefix}-timezone-store'),
             html.Div(id=f'{prefix}-action-output', style={'marginTop': 20}),
         ]
@@ -180,93 +242,60 @@ def register_calendar_callbacks(app, prefix='calendar'):
     )
     @app.callback(
         Output(f'{prefix}-graph', 'figure'),
-        Output(f'{prefix}-scheduled-slots', 'data'),
         Output(f'{prefix}-action-output', 'children'),
-        [Input(f'{prefix}-url', 'pathname'), Input(f'{prefix}-graph', 'clickData')],
-        [State(f'{prefix}-scheduled-slots', 'data'), State(f'{prefix}-timezone-store', 'data')],
+        [
+            Input(f'{prefix}-url', 'pathname'),
+            Input(f'{prefix}-graph', 'clickData'),
+            Input(f'{prefix}-graph', 'selectedData'),
+            Input(f'{prefix}-template-button', 'n_clicks'),
+            Input(f'{prefix}-template', 'n_submit'),
+        ],
+        State(f'{prefix}-timezone-store', 'data'),
+        State(f'{prefix}-mode', 'value'),
+        State(f'{prefix}-profile', 'value'),
+        State(f'{prefix}-template', 'value'),
     )
-    def unified_callback(pathname, clickData, scheduled_slots, timezone_store):
+    def unified_callback(
+        pathname, clickData, selectedData, n_clicks, n_submit, timezone_store, mode, profile, template
+    ):
         ctx = callback_context
         if not ctx.triggered or ctx.triggered[0]['prop_id'].startswith(f'{prefix}-url'):
-            slots = load_schedule()
-            scheduled_set = set(tuple(x) for x in slots)
-            fig = make_figure(scheduled_set, prefix, timezone_store)
-            return fig, slots, ''
-        if scheduled_slots is None:
-            scheduled_slots = []
-        scheduled_set = set(tuple(x) for x in scheduled_slots)
-        msg = ''
-        changed = False
-        if clickData and 'points' in clickData:
+            fig = make_figure(schedule_store.slots(), prefix, timezone_store)
+            return fig, ''
+        trigger = ctx.triggered[0]['prop_id']
+        user_timezone = timezone_store if timezone_store else 'UTC'
+        schedule = mode != 'unschedule'
+        profile = profile or DEFAULT_PROFILE
+        verb = f'scheduled with profile {profile}' if schedule else 'unscheduled'
+        if trigger.startswith(f'{prefix}-template'):
+            try:
+                cells = parse_template(template or '')
+            except ValueError as e:
+                return no_update, f'Template not applied: {e}'
+            changed = edit_cells(cells, schedule, user_timezone, profile)
+            msg = f'{changed} slots {verb} for "{template}" ({user_timezone}).'
+        elif trigger.endswith('selectedData'):
+            # Selections are cleared by update_figure, which reports an empty selection
+            if not selectedData:
+                return no_update, no_update
+            cells = selected_cells(selectedData)
+            if not cells:
+                return no_update, no_update
+            changed = edit_cells(cells, schedule, user_timezone, profile)
+            msg = f'{changed} slots {verb} ({user_timezone}).'
+        else:
+            if not clickData or 'points' not in clickData:
+                return no_update, ''
             pt = clickData['points'][0]
             day = pt['x']
             time_label = pt['y']
-            # Try to get timezone from dcc.Store
-            try:
-                tz_store = callback_context.states.get(f'{prefix}-timezone-store.data', 'UTC')
-            except Exception:
-                tz_store = 'UTC'
-            user_timezone = tz_store if tz_store else 'UTC'
-            slot = (day, time_label, user_timezone)
-            if slot not in scheduled_set:
-                scheduled_set.add(slot)
-                msg = f'Action scheduled for {day} at {time_label} ({user_timezone}).'
-                print(msg)
-                changed = True
-            else:
-                scheduled_set.remove(slot)
+            cell = (DAY_INDEX[day], TIME_INDEX[time_label])
+            # A click flips the cell as the viewer sees it, whoever scheduled it
+            scheduled = cell in viewer_cells(schedule_store.slots(), user_timezone)
+            edit_cells([cell], not scheduled, user_timezone, profile)
+            if scheduled:
                 msg = f'Action unscheduled for {day} at {time_label} ({user_timezone}).'
-                print(msg)
-                changed = True
-        slots_list = list(scheduled_set)
-        if changed:
-            save_schedule(slots_list)
-        fig = make_figure(scheduled_set, prefix, timezone_store)
-        return fig, slots_list, msg
-
-
-def calendar_background_scheduler():
-    last_triggered = set()
-
-    while True:
-        now_utc = datetime.now(pytz.UTC).replace(second=0, microsecond=0)
-        slots = load_schedule()
-        # Each slot is (day, time_label, timezone)
-        for slot in slots:
-            if len(slot) == 3:
-                day_label, time_label, tz_name = slot
-                try:
-                    tz = pytz.timezone(tz_name)
-                except Exception:
-                    tz = pytz.UTC
-                # Build local time for today
-                local_now = datetime.now(tz)
-                # Find the next occurrence of the scheduled day
-                # If today is the scheduled day, check time
-                if local_now.strftime('%A') == day_label:
-                    # Build scheduled local datetime
-                    scheduled_local = tz.localize(datetime(local_now.year, local_now.month, local_now.day,
-                                                          int(time_label[:2]), int(time_label[3:]), 0, 0))
-                    scheduled_utc = scheduled_local.astimezone(pytz.UTC)
-                    # If now_utc matches scheduled_utc (rounded to nearest 15 min)
-                    minute = (now_utc.minute // 15) * 15
-                    current_utc = now_utc.replace(minute=minute)
-                    if scheduled_utc.replace(second=0, microsecond=0) == current_utc:
-                        # Only print once per slot per time
-                        if (day_label, time_label, tz_name) not in last_triggered:
-                            try:
-                                res = globals.vm.start_climate(
-                                    vehicle_id=globals.vehicle_id,
-                                    options=ClimateRequestOptions(
-                                        set_temp=20.5, duration=15, defrost=True
-                                    ),
-                                )
-                            except Exception as e:
-                                res = f'Error starting climate control: {e}'
-                            print(f'Airco response: {res}')
-                            last_triggered.add((day_label, time_label, tz_name))
-        # Clean up last_triggered for slots that are no longer current
-        last_triggered = {
-            (d, t, tz) for (d, t, tz) in last_triggered if (d, t, tz) in [(slot[0], slot[1], slot[2]) for slot in slots]
-        }
-        time_mod.sleep(30)
+            else:
+                msg = f'Action scheduled for {day} at {time_label} ({user_timezone}) with profile {profile}.'
+        logger.info(msg)
+        return update_figure(schedule_store.slots(), timezone_store), msg
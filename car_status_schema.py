@@ -0,0 +1,116 @@
+import math
+from operator import attrgetter
+
+# Converters turn an attribute value into a line protocol field value, or None to skip it
+
+
+def as_int(value):
+    return f'{int(value)}i'
+
+
+def as_float(value):
+    value = float(value)
+    return repr(value) if math.isfinite(value) else None
+
+
+def as_bool(value):
+    return 'true' if value else 'false'
+
+
+def as_str(value):
+    value = str(value).replace('\\', '\\\\').replace('"', '\\"')
+    return f'"{value}"'
+
+
+def seat_on(value):
+    return as_bool(value == 'On')
+
+
+# Field name -> vehicle attribute -> converter.
+# Existing fields keep the type they have always been written with, InfluxDB rejects
+# points that change the type of a field within a shard.
+CAR_STATUS_FIELDS = (
+    ('12v_battery_percentage', 'car_battery_percentage', as_int),
+    ('engine_is_running', 'engine_is_running', as_int),
+    ('smart_key_battery_warning_is_on', 'smart_key_battery_warning_is_on', as_bool),
+    ('washer_fluid_warning_is_on', 'washer_fluid_warning_is_on', as_int),
+    ('brake_fluid_warning_is_on', 'brake_fluid_warning_is_on', as_int),
+    ('air_control_is_on', 'air_control_is_on', as_int),
+    ('defrost_is_on', 'defrost_is_on', as_bool),
+    ('steering_wheel_heater_is_on', 'steering_wheel_heater_is_on', as_bool),
+    ('back_window_heater_is_on', 'back_window_heater_is_on', as_bool),
+    ('side_mirror_heater_is_on', 'side_mirror_heater_is_on', as_bool),
+    ('front_left_seat_status', 'front_left_seat_status', seat_on),
+    ('front_right_seat_status', 'front_right_seat_status', seat_on),
+    ('rear_left_seat_status', 'rear_left_seat_status', seat_on),
+    ('rear_right_seat_status', 'rear_right_seat_status', seat_on),
+    ('is_locked', 'is_locked', as_bool),
+    ('front_left_door_is_open', 'front_left_door_is_open', as_int),
+    ('front_right_door_is_open', 'front_right_door_is_open', as_int),
+    ('back_left_door_is_open', 'back_left_door_is_open', as_int),
+    ('back_right_door_is_open', 'back_right_door_is_open', as_int),
+    ('trunk_is_open', 'trunk_is_open', as_int),
+    ('hood_is_open', 'hood_is_open', as_int),
+    ('front_left_window_is_open', 'front_left_window_is_open', as_int),
+    ('front_right_window_is_open', 'front_right_window_is_open', as_int),
+    ('back_left_window_is_open', 'back_left_window_is_open', as_int),
+    ('back_right_window_is_open', 'back_right_window_is_open', as_int),
+    ('tire_pressure_all_warning_is_on', 'tire_pressure_all_warning_is_on', as_bool),
+    ('tire_pressure_rear_left_warning_is_on', 'tire_pressure_rear_left_warning_is_on', as_bool),
+    ('tire_pressure_front_left_warning_is_on', 'tire_pressure_front_left_warning_is_on', as_bool),
+    ('tire_pressure_front_right_warning_is_on', 'tire_pressure_front_right_warning_is_on', as_bool),
+    ('tire_pressure_rear_right_warning_is_on', 'tire_pressure_rear_right_warning_is_on', as_bool),
+    ('total_power_consumed', 'total_power_consumed', as_int),
+    ('total_power_regenerated', 'total_power_regenerated', as_int),
+    ('power_consumption_30d', 'power_consumption_30d', as_int),
+    ('ev_battery_percentage', 'ev_battery_percentage', as_int),
+    ('ev_battery_soh_percentage', 'ev_battery_soh_percentage', as_int),
+    ('ev_battery_is_charging', 'ev_battery_is_charging', as_bool),
+    ('ev_battery_is_plugged_in', 'ev_battery_is_plugged_in', as_int),
+    ('location_latitude', 'location_latitude', as_float),
+    ('location_longitude', 'location_longitude', as_float),
+    ('odometer', 'odometer', as_float),
+    ('air_temperature', 'air_temperature', as_str),
+    ('air_temperature_c', 'air_temperature', as_float),
+    ('ev_driving_range', 'ev_driving_range', as_float),
+)
+
+
+def escape_tag(value):
+    return str(value).replace('\\', '\\\\').replace(',', '\\,').replace('=', '\\=').replace(' ', '\\ ')
+
+
+def timestamp_ns(dt):
+    return int(dt.timestamp()) * 1_000_000_000 + dt.microsecond * 1000
+
+
+def compile_fields(fields):
+    # Builds a function that renders the line protocol field set of an object
+    getters = tuple((f'{name}=', attrgetter(attr), convert) for name, attr, convert in fields)
+
+    def extract(obj):
+        parts = []
+        for key, getter, convert in getters:
+            try:
+                value = getter(obj)
+                if value is None:
+                    continue
+                value = convert(value)
+            except (TypeError, ValueError):
+                continue
+            if value is not None:
+                parts.append(key + value)
+        return ','.join(parts)
+
+    return extract
+
+
+extract_car_status = compile_fields(CAR_STATUS_FIELDS)
+
+
+def car_status_line(car):
+    # Line protocol for one car_status point, or None if the car reported no fields
+    fields = extract_car_status(car)
+    if not fields:
+        return None
+    return f'car_status,car_id={escape_tag(car.id)} {fields} {timestamp_ns(car.last_updated_at)}'
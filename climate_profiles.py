@@ -0,0 +1,65 @@
+from collections import namedtuple
+from functools import lru_cache
+
+DEFAULT_PROFILE = 'default'
+# Longest climate command the car accepts, in minutes
+MAX_DURATION = 30
+# Temperatures the vendor API accepts (European range, in half degrees)
+MIN_TEMPERATURE = 14.0
+MAX_TEMPERATURE = 29.5
+# Seat heating levels as the vendor API codes them, see SEAT_STATUS in
+# hyundai_kia_connect_api.const
+SEAT_LEVELS = {'off': 0, 'low': 6, 'medium': 7, 'high': 8}
+
+
+class ClimateProfile(namedtuple('ClimateProfile', 'temperature duration defrost seat_heating steering_heating')):
+    # Named climate settings referenced by scheduled slots and the Airco button. Profiles
+    # are immutable and hashable, so request options can be cached per profile.
+    __slots__ = ()
+
+    def __new__(cls, temperature=20.5, duration=15, defrost=True, seat_heating='off', steering_heating=False):
+        temperature = round(float(temperature) * 2) / 2
+        if not MIN_TEMPERATURE <= temperature <= MAX_TEMPERATURE:
+            raise ValueError(f'Temperature must be between {MIN_TEMPERATURE} and {MAX_TEMPERATURE}')
+        duration = int(duration)
+        if not 1 <= duration <= MAX_DURATION:
+            raise ValueError(f'Duration must be between 1 and {MAX_DURATION} minutes')
+        if seat_heating not in SEAT_LEVELS:
+            raise ValueError(f'Seat heating must be one of {", ".join(SEAT_LEVELS)}')
+        return super().__new__(cls, temperature, duration, bool(defrost), seat_heating, bool(steering_heating))
+
+    def to_dict(self):
+        return self._asdict()
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**{field: data[field] for field in cls._fields if field in data})
+
+
+DEFAULT_PROFILES = {
+    DEFAULT_PROFILE: ClimateProfile(),
+    'winter': ClimateProfile(temperature=22.0, seat_heating='high', steering_heating=True),
+    'summer': ClimateProfile(temperature=18.0, duration=10, defrost=False),
+}
+
+
+@lru_cache(maxsize=64)
+def climate_options(profile, duration=None):
+    # ClimateRequestOptions for a profile, built once and reused for every command. Every
+    # field is set, as the vendor library fills in (mutates) fields left at None.
+    from hyundai_kia_connect_api import ClimateRequestOptions
+
+    seat = SEAT_LEVELS[profile.seat_heating]
+    return ClimateRequestOptions(
+        set_temp=profile.temperature,
+        duration=duration or profile.duration,
+        defrost=profile.defrost,
+        climate=True,
+        # Rear window and mirror heating on older cars, includes the steering wheel
+        heating=1 if profile.steering_heating else 0,
+        front_left_seat=seat,
+        front_right_seat=seat,
+        rear_left_seat=0,
+        rear_right_seat=0,
+        steering_wheel=1 if profile.steering_heating else 0,
+    )
@@ -0,0 +1,169 @@
+import heapq
+import logging
+from datetime import datetime, timedelta
+from threading import Event
+
+import pytz
+
+import globals
+from climate_profiles import MAX_DURATION, climate_options
+from metrics import SCHEDULER_DRIFT_SECONDS
+from poll_scheduler import poll_scheduler
+from schedule_grid import DAY_INDEX, SLOT_MINUTES
+from schedule_store import schedule_store
+from slot_time import next_utc_occurrence
+from vehicle_client import vehicle_manager
+
+# A slot that could not be started within its own time window is skipped
+FIRE_WINDOW = timedelta(minutes=SLOT_MINUTES)
+SLOT_DELTA = timedelta(minutes=SLOT_MINUTES)
+# Upper bound on a single sleep, also how often the schedule file is checked for edits
+MAX_SLEEP = 5 * 60
+
+# Set whenever the schedule changes, wakes up the scheduler to re-plan
+schedule_changed = Event()
+# Keeps the last fire time of every slot across leader changes, set by
+# shared_state.start_sync(). Without it, fire times are only kept in memory.
+fire_log = None
+
+logger = logging.getLogger(__name__)
+schedule_store.subscribe(lambda slots: schedule_changed.set())
+
+
+def next_occurrence(slot, after):
+    # First UTC start time of a (day, time, timezone) slot strictly after `after`.
+    # Occurrences are normalized per ISO week of the slot's timezone, so DST changes are
+    # taken into account, and memoized in slot_time.
+    return next_utc_occurrence(slot, after)
+
+
+def plan_schedule(slots, now, fired):
+    # Compile all slots into a heap of (fire time, slot). Slots that are still within
+    # their window are planned too, unless they already fired.
+    heap = []
+    for slot in slots:
+        if len(slot) != 3 or slot[0] not in DAY_INDEX:
+            continue
+        slot = tuple(slot)
+        after = max(now - FIRE_WINDOW, fired.get(slot, now - FIRE_WINDOW))
+        fire_at = next_occurrence(slot, after)
+        if fire_at is not None:
+            heap.append((fire_at, slot))
+    heapq.heapify(heap)
+    return heap
+
+
+def index_due(heap):
+    # Fire time -> slots planned at that time
+    due = {}
+    for fire_at, slot in heap:
+        due.setdefault(fire_at, set()).add(slot)
+    return due
+
+
+def command_chain(slot, fire_at, due):
+    # Slots with the same climate profile that start at the same time as `slot`, or right
+    # after it, are covered by one longer command instead of back-to-back ones.
+    # Returns (profile name, duration in minutes, {covered slot: its fire time}).
+    name = schedule_store.profile_of(slot)
+    profile = schedule_store.climate_profile(name)
+    duration = profile.duration
+    covered = {}
+    t = fire_at
+    while True:
+        same = {
+            other
+            for other in due.get(t, ())
+            if other != slot and schedule_store.profile_of(other) == name
+        }
+        if t > fire_at:
+            extended = int((t - fire_at).total_seconds()) // 60 + profile.duration
+            if not same or extended > MAX_DURATION:
+                break
+            duration = extended
+        covered.update(dict.fromkeys(same, t))
+        t += SLOT_DELTA
+    return name, duration, covered
+
+
+def start_climate(slot, profile_name, duration):
+    try:
+        vm = vehicle_manager()
+        options = climate_options(schedule_store.climate_profile(profile_name), duration)
+        res = vm.start_climate(vehicle_id=globals.snapshot.vehicle_id, options=options)
+        logger.info(
+            'Airco response for %s (%s, %d minutes): %s', slot, profile_name, duration, res
+        )
+    except Exception as e:
+        logger.error('Error starting climate control for %s: %s', slot, e)
+    poll_scheduler.request_poll()
+
+
+def load_fired():
+    if fire_log is None:
+        return {}
+    try:
+        return fire_log.fired_slots()
+    except Exception as e:
+        logger.error('Could not read fired climate slots: %s', e)
+        return {}
+
+
+def record_fired(fire_times):
+    # Before the command is sent, so a new leader never starts these slots again
+    if fire_log is None:
+        return
+    try:
+        fire_log.record_fired(fire_times)
+    except Exception as e:
+        logger.error('Could not store fired climate slots: %s', e)
+
+
+def calendar_background_scheduler():
+    # Slots fired by a previous leader (or run) are not fired again within their window
+    fired = load_fired()
+    # Slot -> fire time of slots that are taken care of by an earlier, longer command
+    covered = {}
+    heap = []
+    due = {}
+    replan = True
+    while True:
+        now = datetime.now(pytz.UTC)
+        if replan:
+            schedule_changed.clear()
+            slots = schedule_store.slots()
+            fired = {slot: t for slot, t in fired.items() if slot in slots}
+            covered = {slot: t for slot, t in covered.items() if slot in slots}
+            heap = plan_schedule(slots, now, fired)
+            due = index_due(heap)
+        while heap and heap[0][0] <= now:
+            fire_at, slot = heapq.heappop(heap)
+            due[fire_at].discard(slot)
+            if not due[fire_at]:
+                del due[fire_at]
+            if not schedule_store.is_scheduled(slot):
+                # Unscheduled since the last plan, the replan is on its way
+                continue
+            if covered.get(slot) == fire_at:
+                del covered[slot]
+            elif now - fire_at < FIRE_WINDOW:
+                SCHEDULER_DRIFT_SECONDS.observe((datetime.now(pytz.UTC) - fire_at).total_seconds())
+                profile_name, duration, chain = command_chain(slot, fire_at, due)
+                covered.update(chain)
+                record_fired({**chain, slot: fire_at})
+                start_climate(slot, profile_name, duration)
+            else:
+                logger.warning('Skipping missed climate slot %s planned at %s', slot, fire_at)
+            fired[slot] = fire_at
+            next_fire = next_occurrence(slot, fire_at)
+            if next_fire is not None:
+                heapq.heappush(heap, (next_fire, slot))
+                due.setdefault(next_fire, set()).add(slot)
+        timeout = MAX_SLEEP
+        if heap:
+            timeout = min(timeout, max((heap[0][0] - now).total_seconds(), 0))
+        # Sleeps until the next slot is due, or until the schedule changes
+        replan = schedule_changed.wait(timeout)
+        if not replan:
+            schedule_store.reload_if_changed()
+            replan = schedule_changed.is_set()
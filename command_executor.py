@@ -0,0 +1,97 @@
+import logging
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+logger = logging.getLogger(__name__)
+
+
+class Job:
+    __slots__ = ('id', 'vin', 'command', 'args', 'status', 'result', 'created_at', 'finished_at')
+
+    def __init__(self, vin, command, args=(), job_id=None):
+        self.id = job_id or uuid.uuid4().hex
+        self.vin = vin
+        self.command = command
+        self.args = tuple(args)
+        self.status = QUEUED
+        self.result = None
+        self.created_at = time.time()
+        self.finished_at = None
+
+    @property
+    def active(self):
+        return self.status in (QUEUED, RUNNING)
+
+
+class CommandExecutor:
+    # Runs registered vehicle commands off the request thread. submit() returns a Job right
+    # away, whose status can be polled by id. A command that is still pending for a vehicle
+    # with the same arguments is not queued twice, and commands for the same vehicle run
+    # one at a time, so e.g. Airco with another profile runs after the pending one.
+    #
+    # With several worker processes, `queue` is the shared state: submit() and get() then
+    # go through it, and only the leader executes the queued jobs (see shared_state).
+
+    def __init__(self, max_workers=4, keep_seconds=60 * 60):
+        self.keep_seconds = keep_seconds
+        self.queue = None
+        self._commands = {}
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='command')
+        self._lock = Lock()
+        self._jobs = {}
+        self._vehicle_locks = {}
+
+    def register(self, command, fn):
+        # Arguments of queued commands are stored as JSON, fn must take plain values
+        self._commands[command] = fn
+
+    def submit(self, vin, command, *args):
+        if self.queue is not None:
+            return self.queue.submit_job(vin, command, args)
+        return self.execute(vin, command, args)
+
+    def get(self, job_id):
+        if self.queue is not None:
+            return self.queue.get_job(job_id)
+        return self._jobs.get(job_id)
+
+    def execute(self, vin, command, args, job_id=None):
+        fn = self._commands[command]
+        args = tuple(args)
+        with self._lock:
+            self._prune()
+            for job in self._jobs.values():
+                if job.active and (job.vin, job.command, job.args) == (vin, command, args):
+                    return job
+            job = Job(vin, command, args, job_id)
+            self._jobs[job.id] = job
+            vehicle_lock = self._vehicle_locks.setdefault(vin, Lock())
+        self._executor.submit(self._run, job, vehicle_lock, fn, args)
+        return job
+
+    def _run(self, job, vehicle_lock, fn, args):
+        with vehicle_lock:
+            job.status = RUNNING
+            try:
+                job.result = fn(*args)
+                job.status = DONE
+            except Exception as e:
+                job.result = e
+                job.status = FAILED
+            job.finished_at = time.time()
+        logger.info('%s for %s %s: %s', job.command, job.vin, job.status, job.result)
+
+    def _prune(self):
+        expired = time.time() - self.keep_seconds
+        for job_id in [j.id for j in self._jobs.values() if not j.active and j.finished_at < expired]:
+            del self._jobs[job_id]
+
+
+command_executor = CommandExecutor()
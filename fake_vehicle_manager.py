@@ -0,0 +1,152 @@
+import math
+import os
+import random
+import time
+import uuid
+from datetime import datetime, timezone
+from threading import Lock
+
+# Simulated vehicle API, selected with VEHICLE_BACKEND=fake. Lets the dashboard, the
+# updater and the scheduler run without a Kia Connect account, e.g. for benchmarks.
+FAKE_VEHICLE_COUNT = int(os.getenv('FAKE_VEHICLE_COUNT', '1'))
+FAKE_LATENCY = float(os.getenv('FAKE_LATENCY', '0.2'))
+FAKE_LATENCY_JITTER = float(os.getenv('FAKE_LATENCY_JITTER', '0.1'))
+FAKE_FAILURE_RATE = float(os.getenv('FAKE_FAILURE_RATE', '0'))
+FAKE_SEED = os.getenv('FAKE_SEED')
+
+
+class FakeApiError(Exception):
+    pass
+
+
+class FakeVehicle:
+    # Carries the attributes the dashboard reads from a hyundai_kia_connect_api Vehicle.
+    # Anything else reads as None, like a value the car did not report.
+
+    def __init__(self, vin, rng):
+        self.id = uuid.uuid5(uuid.NAMESPACE_OID, vin).hex
+        self.VIN = vin
+        self.name = f'Fake {vin}'
+        self.last_updated_at = datetime.now(timezone.utc)
+        self.ev_battery_percentage = rng.uniform(20, 90)
+        self.ev_battery_soh_percentage = 98
+        self.car_battery_percentage = 85
+        self.ev_driving_range = self.ev_battery_percentage * 4.5
+        self.ev_battery_is_plugged_in = False
+        self.ev_battery_is_charging = False
+        self.odometer = rng.uniform(1000, 50000)
+        self.air_control_is_on = False
+        self.air_temperature = 15.0
+        self.location_latitude = 51.0 + rng.uniform(-0.5, 0.5)
+        self.location_longitude = 5.5 + rng.uniform(-0.5, 0.5)
+        self.is_locked = True
+        self.engine_is_running = False
+
+    def __getattr__(self, name):
+        # Only called for attributes that are not set
+        return None
+
+
+class FakeVehicleManager:
+    # The subset of VehicleManager used by this project. Every call takes FAKE_LATENCY
+    # (plus jitter) and fails with probability FAKE_FAILURE_RATE. Each cached state update
+    # moves the simulation on: vehicles alternate between driving, parking and charging.
+
+    def __init__(
+        self,
+        vins=None,
+        count=FAKE_VEHICLE_COUNT,
+        latency=FAKE_LATENCY,
+        jitter=FAKE_LATENCY_JITTER,
+        failure_rate=FAKE_FAILURE_RATE,
+        seed=FAKE_SEED,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.token = None
+        self.vehicles = {}
+        self.calls = 0
+        self._rng = random.Random(seed)
+        self._lock = Lock()
+        self._vins = [vin for vin in (vins or []) if vin != '*']
+        self._vins += [f'FAKE{i:013d}' for i in range(len(self._vins), count)]
+
+    def _call(self):
+        with self._lock:
+            self.calls += 1
+            delay = max(0.0, self.latency + self._rng.uniform(-self.jitter, self.jitter))
+            failed = self._rng.random() < self.failure_rate
+        time.sleep(delay)
+        if failed:
+            raise FakeApiError('Simulated vehicle API failure')
+
+    def check_and_refresh_token(self):
+        self._call()
+        if not self.vehicles:
+            self.initialize_vehicles()
+        return False
+
+    def initialize_vehicles(self):
+        self._call()
+        for vin in self._vins:
+            vehicle = FakeVehicle(vin, self._rng)
+            self.vehicles[vehicle.id] = vehicle
+
+    def get_vehicle(self, vehicle_id):
+        return self.vehicles[vehicle_id]
+
+    def update_vehicle_with_cached_state(self, vehicle_id):
+        self._call()
+        with self._lock:
+            self._advance(self.vehicles[vehicle_id])
+
+    def force_refresh_vehicle_state(self, vehicle_id):
+        self._call()
+        self._call()
+        with self._lock:
+            self._advance(self.vehicles[vehicle_id])
+
+    def start_climate(self, vehicle_id, options=None):
+        self._call()
+        self.vehicles[vehicle_id].air_control_is_on = True
+        return uuid.uuid4().hex
+
+    def stop_climate(self, vehicle_id):
+        self._call()
+        self.vehicles[vehicle_id].air_control_is_on = False
+        return uuid.uuid4().hex
+
+    def start_charge(self, vehicle_id):
+        self._call()
+        vehicle = self.vehicles[vehicle_id]
+        vehicle.ev_battery_is_plugged_in = True
+        vehicle.ev_battery_is_charging = True
+        return uuid.uuid4().hex
+
+    def stop_charge(self, vehicle_id):
+        self._call()
+        self.vehicles[vehicle_id].ev_battery_is_charging = False
+        return uuid.uuid4().hex
+
+    def _advance(self, vehicle):
+        rng = self._rng
+        if vehicle.ev_battery_is_charging:
+            vehicle.ev_battery_percentage = min(100.0, vehicle.ev_battery_percentage + rng.uniform(1, 5))
+            if vehicle.ev_battery_percentage >= 100.0:
+                vehicle.ev_battery_is_charging = False
+        elif vehicle.ev_battery_percentage < 25 or rng.random() < 0.1:
+            vehicle.ev_battery_is_plugged_in = True
+            vehicle.ev_battery_is_charging = True
+        elif rng.random() < 0.5:
+            # Drive a bit
+            distance = rng.uniform(1, 20)
+            heading = rng.uniform(0, 2 * math.pi)
+            vehicle.ev_battery_is_plugged_in = False
+            vehicle.odometer += distance
+            vehicle.ev_battery_percentage = max(0.0, vehicle.ev_battery_percentage - distance / 4.5)
+            vehicle.location_latitude += distance / 111 * math.cos(heading)
+            vehicle.location_longitude += distance / 70 * math.sin(heading)
+        vehicle.ev_driving_range = round(vehicle.ev_battery_percentage * 4.5)
+        vehicle.air_temperature = round(15 + rng.uniform(-5, 5), 1)
+        vehicle.last_updated_at = datetime.now(timezone.utc)
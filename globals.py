@@ -1,26 +1,23 @@
 # globals.py
 import os
 
+from vehicle_snapshot import VehicleSnapshot
+
 LICENSE_PLATE = os.getenv('LICENSE_PLATE', 'ABC-123')
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = '%(asctime)s level=%(levelname)s logger=%(name)s thread=%(threadName)s msg="%(message)s"'
 
 USERNAME = os.getenv('USERNAME', 'default_user')
 PASSWORD = os.getenv('PASSWORD', 'default_password')
 PIN = os.getenv('PIN', '0000')
 VIN = os.getenv('VIN', 'default_vin')
+# Comma separated VINs to track, '*' tracks every vehicle on the account
+VINS = [vin.strip() for vin in (os.getenv('VINS') or VIN).split(',') if vin.strip()]
 
-vehicle_id = ''
 vm = None
 
-latest_update = None
-battery_soc_num = 99.0
-battery_soh_num = 0.0
-battery_12v_soc = 99.0
-battery_range_num = 999.0
-charging_busy = False
-mileage_num = 0
-airo_status = False
-outside_temp = 0.0
-vehicle_pos = {'Vehicle': [LICENSE_PLATE], 'latitude': [51.0], 'longitude': [5.5]}
-vehicle_pos_num = [51.0, 5.5]
-vehicle_id = None
+# Latest published VehicleSnapshot per VIN, and the one of the primary vehicle (VIN).
+# Both are only ever replaced as a whole, never mutated.
+snapshots = {}
+snapshot = VehicleSnapshot()
 mapbox_style = 'open-street-map'
@@ -0,0 +1,12 @@
+import multiprocessing
+import os
+
+bind = os.getenv('BIND', '0.0.0.0:8080')
+workers = int(os.getenv('WEB_CONCURRENCY', str(min(multiprocessing.cpu_count(), 4))))
+# Every open dashboard tab keeps a Server-Sent Events stream, which holds a thread
+worker_class = 'gthread'
+threads = int(os.getenv('WEB_THREADS', '32'))
+# Background threads are started after the fork, in the worker that wins the election
+preload_app = False
+graceful_timeout = 10
+accesslog = None
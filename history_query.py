@@ -0,0 +1,104 @@
+import math
+import time
+from collections import OrderedDict
+from threading import Lock
+
+from influx_writer import INFLUXDB_TOKEN, influx_bucket, influx_org, influx_url
+
+# Field -> (label, aggregate function) of the series shown in the history tab
+HISTORY_FIELDS = {
+    'ev_battery_percentage': ('State of charge (%)', 'mean'),
+    'ev_driving_range': ('Range (km)', 'mean'),
+    '12v_battery_percentage': ('12V battery (%)', 'mean'),
+    'power_consumption_30d': ('Consumption last 30 days', 'last'),
+    'odometer': ('Odometer (km)', 'max'),
+}
+
+# Window sizes in seconds, the smallest one that gives at most one point per pixel is used
+WINDOWS = (60, 5 * 60, 15 * 60, 30 * 60, 60 * 60, 3 * 3600, 6 * 3600, 12 * 3600, 86400, 7 * 86400)
+
+
+class TTLCache:
+    # Least recently used cache whose entries also expire after their own ttl
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self._lock = Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+
+history_cache = TTLCache()
+_query_api = None
+
+
+def query_api():
+    global _query_api
+    if _query_api is None:
+        import influxdb_client
+
+        client = influxdb_client.InfluxDBClient(url=influx_url, token=INFLUXDB_TOKEN, org=influx_org)
+        _query_api = client.query_api()
+    return _query_api
+
+
+def window_for(range_seconds, width_px):
+    target = range_seconds / max(width_px, 1)
+    for window in WINDOWS:
+        if window >= target:
+            return window
+    return WINDOWS[-1]
+
+
+def history_flux(field, range_seconds, window, car_id=None):
+    aggregate = HISTORY_FIELDS[field][1]
+    car_filter = ''
+    if car_id:
+        car_id = str(car_id).replace('\\', '\\\\').replace('"', '\\"')
+        car_filter = f' and r.car_id == "{car_id}"'
+    return (
+        f'from(bucket: "{influx_bucket}")\n'
+        f'  |> range(start: -{range_seconds}s)\n'
+        f'  |> filter(fn: (r) => r._measurement == "car_status" and r._field == "{field}"{car_filter})\n'
+        f'  |> aggregateWindow(every: {window}s, fn: {aggregate}, createEmpty: false)\n'
+        f'  |> keep(columns: ["_time", "_value"])\n'
+    )
+
+
+def query_history(field, range_seconds, width_px, car_id=None):
+    # Downsampled (times, values) of a car_status field, with at most about one point per
+    # pixel. Results are cached per (field, range, resolution, car).
+    window = window_for(range_seconds, width_px)
+    key = (field, range_seconds, window, car_id)
+    result = history_cache.get(key)
+    if result is not None:
+        return result
+    times = []
+    values = []
+    for record in query_api().query_stream(history_flux(field, range_seconds, window, car_id)):
+        value = record.get_value()
+        if value is not None and not (isinstance(value, float) and math.isnan(value)):
+            times.append(record.get_time())
+            values.append(value)
+    result = (times, values)
+    # New points only ever end up in the last window, no use refreshing faster than that
+    history_cache.put(key, result, ttl=min(max(window, 60), 15 * 60))
+    return result
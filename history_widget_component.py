@@ -0,0 +1,106 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from dash import Input, Output, dcc, html
+from dash.exceptions import PreventUpdate
+from plotly.subplots import make_subplots
+
+import globals
+from history_query import HISTORY_FIELDS, query_history
+
+HISTORY_RANGES = {
+    '1d': 86400,
+    '7d': 7 * 86400,
+    '30d': 30 * 86400,
+    '90d': 90 * 86400,
+    '365d': 365 * 86400,
+}
+
+_query_executor = ThreadPoolExecutor(max_workers=len(HISTORY_FIELDS), thread_name_prefix='history')
+
+logger = logging.getLogger(__name__)
+
+
+def make_history_figure(series):
+    fig = make_subplots(
+        rows=len(series),
+        cols=1,
+        shared_xaxes=True,
+        vertical_spacing=0.04,
+        subplot_titles=[label for label, _, _ in series],
+    )
+    for row, (label, times, values) in enumerate(series, start=1):
+        fig.add_scatter(x=times, y=values, name=label, mode='lines', row=row, col=1)
+    fig.update_layout(
+        height=250 * len(series),
+        showlegend=False,
+        margin=dict(l=40, r=40, t=40, b=40),
+    )
+    return fig
+
+
+def get_history_layout(prefix='history'):
+    return html.Div(
+        [
+            dcc.Store(id=f'{prefix}-width-store'),
+            dcc.Dropdown(
+                id=f'{prefix}-vehicle-select',
+                options=[],
+                placeholder='Primary vehicle',
+                clearable=True,
+            ),
+            dcc.RadioItems(
+                id=f'{prefix}-range',
+                options=[{'label': r, 'value': r} for r in HISTORY_RANGES],
+                value='7d',
+                inline=True,
+            ),
+            dcc.Loading(dcc.Graph(id=f'{prefix}-graph', config={'displayModeBar': False})),
+            html.Div(id=f'{prefix}-error-txt'),
+        ]
+    )
+
+
+def register_history_callbacks(app, prefix='history', tabs_id='tabs', tab_value='history'):
+    # Clientside callback to detect the available width in pixels
+    app.clientside_callback(
+        '''
+        function(tab) {
+            return window.innerWidth;
+        }
+        ''',
+        Output(f'{prefix}-width-store', 'data'),
+        Input(tabs_id, 'value'),
+    )
+
+    @app.callback(
+        Output(f'{prefix}-graph', 'figure'),
+        Output(f'{prefix}-vehicle-select', 'options'),
+        Output(f'{prefix}-error-txt', 'children'),
+        Input(tabs_id, 'value'),
+        Input(f'{prefix}-range', 'value'),
+        Input(f'{prefix}-vehicle-select', 'value'),
+        Input(f'{prefix}-width-store', 'data'),
+    )
+    def update_history(tab, range_label, vin, width):
+        # Only query InfluxDB while the tab is actually shown
+        if tab != tab_value:
+            raise PreventUpdate
+        snapshots = globals.snapshots
+        options = [{'label': snap.name or v, 'value': v} for v, snap in snapshots.items()]
+        car_id = (snapshots.get(vin) or globals.snapshot).vehicle_id
+        range_seconds = HISTORY_RANGES.get(range_label, HISTORY_RANGES['7d'])
+        futures = {
+            field: _query_executor.submit(
+                query_history, field, range_seconds, width or 1000, car_id
+            )
+            for field in HISTORY_FIELDS
+        }
+        try:
+            series = [
+                (HISTORY_FIELDS[field][0], *future.result()) for field, future in futures.items()
+            ]
+        except Exception as e:
+            logger.error('Error querying history: %s', e)
+            return {}, options, f'Could not load history: {e}'
+        return make_history_figure(series), options, ''
@@ -0,0 +1,45 @@
+import importlib.util
+import logging
+
+from flask import request
+
+# Fingerprinted urls change whenever the file does, so they can be cached for good
+ONE_YEAR = 365 * 24 * 60 * 60
+
+logger = logging.getLogger(__name__)
+
+
+def configure_compression(server):
+    # Returns whether Dash can compress responses, flask-compress is an optional dependency.
+    # Brotli is preferred when the client and the installed packages support it. Server-Sent
+    # Events (text/event-stream) are not in COMPRESS_MIMETYPES, so the stream is never
+    # buffered by the compressor.
+    if importlib.util.find_spec('flask_compress') is None:
+        logger.warning('flask-compress is not installed, responses are sent uncompressed')
+        return False
+    algorithms = ['gzip']
+    if importlib.util.find_spec('brotli') is not None:
+        algorithms.insert(0, 'br')
+    server.config.setdefault('COMPRESS_ALGORITHM', algorithms)
+    return True
+
+
+def register_cache_headers(app):
+    # Component bundles are fingerprinted by Dash itself, assets get the file mtime appended
+    # as ?m=. Both can be cached by the browser until the url changes.
+    assets_path = app.get_asset_url('')
+    suites_path = app.config.requests_pathname_prefix + '_dash-component-suites/'
+
+    @app.server.after_request
+    def cache_static(response):
+        if response.status_code != 200:
+            return response
+        if request.path.startswith(assets_path) and request.args.get('m'):
+            response.cache_control.no_cache = None
+            response.cache_control.max_age = ONE_YEAR
+            response.cache_control.public = True
+            response.cache_control.immutable = True
+        elif request.path.startswith(suites_path) and response.cache_control.max_age:
+            response.cache_control.public = True
+            response.cache_control.immutable = True
+        return response
@@ -0,0 +1,190 @@
+import atexit
+import logging
+import os
+import queue
+import random
+import time
+from threading import Thread
+
+from metrics import INFLUX_RECORDS, INFLUX_WRITE_SECONDS, Gauge, registry
+
+INFLUXDB_TOKEN = os.getenv('INFLUXDB_TOKEN', 'default_influxdb_token')
+
+influx_org = 'myorg'
+influx_url = os.getenv('INFLUXDB_URL', 'http://influxdb:8086')
+influx_bucket = 'mybucket'
+influx_spool_file = os.getenv('INFLUX_SPOOL_FILE', 'influx_spool.lp')
+
+# Rejected by InfluxDB because of the data itself, retrying won't help
+PERMANENT_ERRORS = (400, 422)
+
+logger = logging.getLogger(__name__)
+
+
+class InfluxWriter:
+    # Writes records to InfluxDB from a background thread, so callers never wait on it.
+    # Records are sent in batches. While InfluxDB is unreachable they are appended to a
+    # line protocol spool file, which is replayed once writes succeed again.
+
+    def __init__(
+        self,
+        url,
+        token,
+        org,
+        bucket,
+        spool_path,
+        max_queue=1000,
+        batch_size=500,
+        flush_interval=5.0,
+        max_backoff=15 * 60,
+        timeout=10_000,
+    ):
+        self.bucket = bucket
+        self.org = org
+        self.spool_path = spool_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_backoff = max_backoff
+        self._client_args = dict(url=url, token=token, org=org, timeout=timeout)
+        self._write_api = None
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        self._failures = 0
+        self._retry_at = 0.0
+        self._spooled = os.path.exists(spool_path)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = Thread(target=self._run, name='influx-writer', daemon=True)
+            self._thread.start()
+
+    def write(self, record):
+        # record is a Point or a line protocol string
+        if not isinstance(record, str):
+            record = record.to_line_protocol()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            INFLUX_RECORDS.inc(outcome='dropped')
+            logger.warning('InfluxDB write queue is full, dropping record')
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def stop(self, timeout=5.0):
+        if self._thread is None:
+            return
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self._thread.join(timeout)
+
+    def _next_batch(self):
+        # Waits up to flush_interval for a first record, then takes what is queued up to
+        # batch_size. Also reports whether stop() was called.
+        batch = []
+        try:
+            record = self._queue.get(timeout=self.flush_interval)
+            while record is not None:
+                batch.append(record)
+                if len(batch) >= self.batch_size:
+                    break
+                record = self._queue.get_nowait()
+        except queue.Empty:
+            return batch, False
+        return batch, record is None
+
+    def _connect(self):
+        # influxdb_client takes a while to import, only load it in the writer thread
+        import influxdb_client
+        from influxdb_client.client.write_api import SYNCHRONOUS
+
+        client = influxdb_client.InfluxDBClient(**self._client_args)
+        self._write_api = client.write_api(write_options=SYNCHRONOUS)
+
+    def _run(self):
+        self._connect()
+        stopping = False
+        while not stopping:
+            batch, stopping = self._next_batch()
+            if time.monotonic() < self._retry_at:
+                self._spool(batch)
+                continue
+            try:
+                self._send(batch)
+            except Exception as e:
+                self._failed(e, batch)
+                continue
+            try:
+                if self._spooled:
+                    self._replay_spool()
+                self._failures = 0
+            except Exception as e:
+                self._failed(e, [])
+
+    def _send(self, lines):
+        if lines:
+            with INFLUX_WRITE_SECONDS.time():
+                self._write_api.write(bucket=self.bucket, org=self.org, record='\n'.join(lines))
+            INFLUX_RECORDS.inc(len(lines), outcome='written')
+
+    def _failed(self, error, batch):
+        from influxdb_client.rest import ApiException
+
+        if isinstance(error, ApiException) and error.status in PERMANENT_ERRORS:
+            INFLUX_RECORDS.inc(len(batch), outcome='rejected')
+            logger.error('InfluxDB rejected %d records, dropping them: %s', len(batch), error)
+            return
+        self._spool(batch)
+        self._failures += 1
+        backoff = min(self.max_backoff, self.flush_interval * 2 ** self._failures)
+        self._retry_at = time.monotonic() + backoff * random.uniform(0.5, 1.0)
+        logger.warning('Error writing to InfluxDB, retrying in at most %.0f s: %s', backoff, error)
+
+    def _spool(self, lines):
+        if not lines:
+            return
+        with open(self.spool_path, 'a') as f:
+            f.write('\n'.join(lines) + '\n')
+        INFLUX_RECORDS.inc(len(lines), outcome='spooled')
+        self._spooled = True
+
+    def _replay_spool(self):
+        from influxdb_client.rest import ApiException
+
+        with open(self.spool_path, 'r') as f:
+            lines = [line for line in f.read().splitlines() if line]
+        for i in range(0, len(lines), self.batch_size):
+            try:
+                self._send(lines[i : i + self.batch_size])
+            except ApiException as e:
+                if e.status not in PERMANENT_ERRORS:
+                    self._rewrite_spool(lines[i:])
+                    raise
+                logger.error('InfluxDB rejected spooled records, dropping them: %s', e)
+            except Exception:
+                self._rewrite_spool(lines[i:])
+                raise
+        os.remove(self.spool_path)
+        self._spooled = False
+        logger.info('Replayed %d spooled records to InfluxDB', len(lines))
+
+    def _rewrite_spool(self, lines):
+        tmp_path = self.spool_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp_path, self.spool_path)
+
+
+influx_writer = InfluxWriter(
+    influx_url, INFLUXDB_TOKEN, influx_org, influx_bucket, influx_spool_file
+)
+atexit.register(influx_writer.stop)
+registry.register(
+    Gauge(
+        'kia_influx_queue_depth',
+        'Records waiting to be written to InfluxDB',
+        lambda: {(): influx_writer.queue_depth()},
+    )
+)
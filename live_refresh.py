@@ -0,0 +1,125 @@
+import logging
+import math
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+from threading import Lock
+
+from flask import jsonify
+
+import globals
+from metrics import LIVE_REFRESHES
+from poll_scheduler import poll_scheduler
+from rest_updater import poll_vehicle, publish_snapshots, tracked_vehicles
+from state_cache import save_state
+from vehicle_client import VendorApiTimeout, VendorApiUnavailable, vehicle_manager
+
+# A live refresh wakes the car and drains its 12V battery, so a vehicle is refreshed at
+# most once per interval. Requests in between get the result of the previous refresh.
+FORCE_REFRESH_MIN_INTERVAL = float(os.getenv('FORCE_REFRESH_MIN_INTERVAL', str(10 * 60)))
+# How long an API request waits for the car before answering 504
+FORCE_REFRESH_WAIT = float(os.getenv('FORCE_REFRESH_WAIT', '120'))
+
+logger = logging.getLogger(__name__)
+
+
+class LiveRefresher:
+    # Single-flight live refreshes per VIN. Every request for a vehicle that is already
+    # being refreshed, or was refreshed less than `min_interval` ago, gets the same Future,
+    # so all callers see the same snapshot or the same exception.
+    #
+    # With several worker processes, `queue` is the shared state: refresh() then hands the
+    # request to the leader, which is the only process that calls submit().
+
+    def __init__(self, fetch, min_interval=FORCE_REFRESH_MIN_INTERVAL, max_workers=2):
+        self.fetch = fetch
+        self.min_interval = min_interval
+        self.queue = None
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='refresh')
+        self._lock = Lock()
+        self._flights = {}
+
+    def submit(self, vin, min_interval=None):
+        min_interval = self.min_interval if min_interval is None else min_interval
+        now = time.monotonic()
+        with self._lock:
+            self._prune(now)
+            flight = self._flights.get(vin)
+            if flight is not None:
+                started_at, _, future = flight
+                if not future.done():
+                    LIVE_REFRESHES.inc(outcome='joined')
+                    return future
+                # A refresh the client refused never reached the car, it does not count
+                if now - started_at < min_interval and not isinstance(
+                    future.exception(), VendorApiUnavailable
+                ):
+                    LIVE_REFRESHES.inc(outcome='recent')
+                    return future
+            LIVE_REFRESHES.inc(outcome='started')
+            future = self._executor.submit(self.fetch, vin)
+            self._flights[vin] = (now, max(min_interval, self.min_interval), future)
+        return future
+
+    def _prune(self, now):
+        # Finished refreshes are only needed while they can still be handed out as recent
+        expired = [
+            vin
+            for vin, (started_at, keep, future) in self._flights.items()
+            if future.done() and now - started_at >= keep
+        ]
+        for vin in expired:
+            del self._flights[vin]
+
+    def refresh(self, vin, timeout=None):
+        if self.queue is not None:
+            return self.queue.refresh(vin, timeout)
+        return self.submit(vin).result(timeout)
+
+
+def refresh_vehicle(vin):
+    # Asks the car itself for its state instead of the vendor's cached copy
+    vm = vehicle_manager()
+    vehicle = tracked_vehicles(vm).get(vin)
+    if vehicle is None:
+        raise LookupError(f'Unknown vehicle {vin}')
+    # Live refreshes count against the same daily budget as the polls
+    wait = poll_scheduler.spend(1)
+    if wait:
+        raise VendorApiUnavailable('The daily vehicle API call budget is used up', wait)
+    snap = poll_vehicle(vehicle, globals.snapshots.get(vin), force=True)
+    publish_snapshots({**globals.snapshots, vin: snap})
+    logger.info('Live refresh of %s, data from %s', vin, snap.last_updated_at)
+    try:
+        save_state()
+    except Exception as e:
+        logger.warning('Could not write state cache: %s', e)
+    return snap
+
+
+live_refresher = LiveRefresher(refresh_vehicle)
+
+
+def register_refresh_routes(server):
+    @server.route('/api/vehicles/<vin>/refresh', methods=['POST'])
+    def refresh(vin):
+        # Only vehicles with data are refreshed, anything else would sit in the queue
+        # until FORCE_REFRESH_WAIT runs out
+        if vin not in globals.snapshots:
+            return jsonify(error=f'Unknown vehicle {vin}'), 404
+        try:
+            snap = live_refresher.refresh(vin, FORCE_REFRESH_WAIT)
+        except LookupError as e:
+            return jsonify(error=str(e)), 404
+        except VendorApiUnavailable as e:
+            response = jsonify(error=str(e))
+            response.status_code = 503
+            response.headers['Retry-After'] = str(math.ceil(e.retry_after))
+            return response
+        except (FutureTimeout, VendorApiTimeout):
+            return jsonify(error='The car did not answer in time'), 504
+        except Exception as e:
+            logger.error('Live refresh of %s failed: %s', vin, e)
+            return jsonify(error=str(e)), 502
+        return jsonify(vin=vin, snapshot=snap.to_dict())
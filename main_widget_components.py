@@ -1,37 +1,188 @@
+from collections import OrderedDict
+from functools import partial
+from threading import Lock
+
 import dash
 import dash_daq as daq
-import plotly.express as px
 from dash import dcc, html
-from hyundai_kia_connect_api import *
 
 import globals
+from climate_profiles import DEFAULT_PROFILE, climate_options
+from command_executor import DONE, FAILED, command_executor
+from live_refresh import live_refresher
+from poll_scheduler import poll_scheduler
+from schedule_store import schedule_store
+from vehicle_client import vehicle_manager
 
+MAP_CACHE_SIZE = 16
+_map_cache = OrderedDict()
+_map_cache_lock = Lock()
 
-globals.vm = VehicleManager(
-    region=1, brand=1, username=globals.USERNAME, password=globals.PASSWORD, pin=globals.PIN
-)
 
-def create_vehicle_map(width=600, height=600, zoom=13):
-    fig = px.scatter_map(
-        globals.vehicle_pos,
-        lat='latitude',
-        lon='longitude',
-        hover_name='Vehicle',
-        map_style=globals.mapbox_style,
-        size=[12],
-        width=width,
-        height=height,
-        zoom=zoom,
+def create_vehicle_map(snapshot, width=600, height=600, zoom=13):
+    # Figures are cached per (lat, lon, style, size, zoom), evicting the least recently used
+    key = (snapshot.latitude, snapshot.longitude, globals.mapbox_style, width, height, zoom)
+    with _map_cache_lock:
+        fig = _map_cache.get(key)
+        if fig is not None:
+            _map_cache.move_to_end(key)
+            return fig
+    # A plain figure dict: plotly.express would pull in pandas, whose import is not safe
+    # to run on concurrent request threads. Cached figures are shared, callers must not
+    # mutate them.
+    fig = dict(
+        data=[
+            dict(
+                type='scattermap',
+                lat=[snapshot.latitude],
+                lon=[snapshot.longitude],
+                mode='markers',
+                marker=dict(size=20, color='#636efa'),
+                hovertext=[globals.LICENSE_PLATE],
+                hovertemplate='<b>%{hovertext}</b><br><br>latitude=%{lat}<br>longitude=%{lon}<extra></extra>',
+                showlegend=False,
+            )
+        ],
+        layout=dict(
+            map=dict(
+                style=globals.mapbox_style,
+                center=dict(lat=snapshot.latitude, lon=snapshot.longitude),
+                zoom=zoom,
+            ),
+            width=width,
+            height=height,
+            margin=dict(l=0, r=0, t=0, b=0),
+        ),
     )
-    fig.update_layout(margin=dict(l=0, r=0, t=0, b=0))
+    with _map_cache_lock:
+        _map_cache[key] = fig
+        while len(_map_cache) > MAP_CACHE_SIZE:
+            _map_cache.popitem(last=False)
     return fig
 
 
+def move_vehicle_marker(snapshot):
+    # Partial figure update that only moves the marker and the map center
+    patch = dash.Patch()
+    patch['data'][0]['lat'] = [snapshot.latitude]
+    patch['data'][0]['lon'] = [snapshot.longitude]
+    patch['layout']['map']['center'] = dict(lat=snapshot.latitude, lon=snapshot.longitude)
+    return patch
+
+
+# (component id suffix, property) of every widget refreshed by the dashboard interval
+REFRESH_OUTPUTS = (
+    ('update-txt', 'children'),
+    ('battery-soc', 'value'),
+    ('battery-soh', 'value'),
+    ('12v-soc', 'value'),
+    ('range-txt', 'children'),
+    ('charging-indicator', 'value'),
+    ('charging-indicator', 'label'),
+    ('mileage', 'value'),
+    ('airco-indicator', 'value'),
+    ('temperature-txt', 'children'),
+    ('latitude-txt', 'children'),
+    ('longitude-txt', 'children'),
+    ('car-position-url', 'href'),
+)
+
+
+def start_climate(vehicle_id, profile=DEFAULT_PROFILE):
+    return vehicle_manager().start_climate(
+        vehicle_id=vehicle_id,
+        options=climate_options(schedule_store.climate_profile(profile)),
+    )
+
+
+def start_charge(vehicle_id):
+    return vehicle_manager().start_charge(vehicle_id=vehicle_id)
+
+
+def stop_charge(vehicle_id):
+    return vehicle_manager().stop_charge(vehicle_id=vehicle_id)
+
+
+def refresh_from_car(vehicle_id):
+    # Joins any refresh of this car that is running or just finished. Commands run on the
+    # leader, so this refreshes in-process rather than through the shared state.
+    vin = next((vin for vin, snap in globals.snapshots.items() if snap.vehicle_id == vehicle_id), None)
+    if vin is None:
+        raise LookupError('No data for this vehicle yet')
+    snap = live_refresher.submit(vin).result()
+    return f'live data from {snap.last_updated_at} UTC'
+
+
+# Button id suffix -> (label, command)
+COMMANDS = {
+    'refresh-button': ('refresh-from-car', refresh_from_car),
+    'airco-button': ('Airco', start_climate),
+    'start-charge-button': ('start-charge', start_charge),
+    'stop-charge-button': ('stop-charge', stop_charge),
+}
+MAX_SHOWN_JOBS = 5
+
+
+def run_command(fn, vehicle_id, *args):
+    try:
+        return fn(vehicle_id, *args)
+    finally:
+        poll_scheduler.request_poll()
+
+
+for label, fn in COMMANDS.values():
+    command_executor.register(label, partial(run_command, fn))
+
+
+def job_message(job):
+    if job.status == DONE:
+        return f'{job.command} response: {job.result}'
+    if job.status == FAILED:
+        return f'{job.command} failed: {job.result}'
+    return f'{job.command} {job.status}...'
+
+
+def selected_snapshot(vin):
+    # Snapshot of the vehicle picked in the dropdown, defaults to the primary vehicle
+    return globals.snapshots.get(vin) or globals.snapshot
+
+
+def vehicle_options(snapshots):
+    return [{'label': snap.name or vin, 'value': vin} for vin, snap in snapshots.items()]
+
+
+def dashboard_values(snapshot):
+    # Rendered widget values in REFRESH_OUTPUTS order
+    return [
+        f'Latest update from: {snapshot.last_updated_at} UTC',
+        snapshot.battery_soc,
+        snapshot.battery_soh,
+        snapshot.battery_12v_soc,
+        f'Remaining range: {snapshot.battery_range} km',
+        snapshot.is_plugged_in,
+        'Charging in progress' if snapshot.is_plugged_in else 'Charger disconnected',
+        snapshot.mileage,
+        snapshot.airco_status,
+        f'{snapshot.outside_temp} °C',
+        f'Latitude: {snapshot.latitude}',
+        f'Longitude: {snapshot.longitude}',
+        f'https://maps.google.com/maps?q={snapshot.latitude},{snapshot.longitude}',
+    ]
+
+
 def get_main_layout(prefix='main'):
     return html.Div(
         [
             dcc.Interval(id=f'{prefix}-interval-component', interval=10 * 1000),
+            dcc.Store(id=f'{prefix}-rendered-store'),
+            dcc.Store(id=f'{prefix}-push-store'),
             html.H1(f'{globals.LICENSE_PLATE} car status'),
+            dcc.Dropdown(
+                id=f'{prefix}-vehicle-select',
+                options=[],
+                placeholder='Primary vehicle',
+                clearable=True,
+            ),
             html.Div(id=f'{prefix}-update-txt', style=dict(height='3pc', overflow='auto')),
             html.H4('Battery state of charge:'),
             daq.GraduatedBar(
@@ -101,17 +252,26 @@ def get_main_layout(prefix='main'):
             html.H4('Gimmicks:'),
             html.Div(
                 [
-                    html.Div(id=f'{prefix}-airco-output', hidden=True),
+                    html.Button(
+                        'Refresh from car',
+                        id=f'{prefix}-refresh-button',
+                        style={'display': 'inline-block'},
+                    ),
                     html.Button(
                         'Airco', id=f'{prefix}-airco-button', style={'display': 'inline-block'}
                     ),
-                    html.Div(id=f'{prefix}-start-charge-output', hidden=True),
+                    dcc.Dropdown(
+                        id=f'{prefix}-airco-profile',
+                        options=[{'label': name, 'value': name} for name in schedule_store.profiles()],
+                        value=DEFAULT_PROFILE,
+                        clearable=False,
+                        style={'display': 'inline-block', 'width': 150, 'verticalAlign': 'middle'},
+                    ),
                     html.Button(
                         'Start Charge',
                         id=f'{prefix}-start-charge-button',
                         style={'display': 'inline-block'},
                     ),
-                    html.Div(id=f'{prefix}-stop-charge-output', hidden=True),
                     html.Button(
                         'Stop Charge',
                         id=f'{prefix}-stop-charge-button',
@@ -119,6 +279,8 @@ def get_main_layout(prefix='main'):
                     ),
                 ]
             ),
+            dcc.Store(id=f'{prefix}-jobs-store'),
+            dcc.Interval(id=f'{prefix}-job-interval', interval=1000, disabled=True),
             html.Div(
                 id=f'{prefix}-log-div',
                 style=dict(height='5pc', overflow='auto', border='2px solid powderblue'),
@@ -134,7 +296,8 @@ def get_main_layout(prefix='main'):
             ),
             dash.dcc.Graph(
                 id=f'{prefix}-map',
-                figure=create_vehicle_map(),
+                # Filled in by the first refresh
+                figure={},
                 style={'width': '100%', 'height': '600px'},
             ),
         ]
@@ -143,106 +306,153 @@ def get_main_layout(prefix='main'):
 def register_main_callbacks(app, prefix='main'):
     # Callbacks
     @app.callback(
-        dash.dependencies.Output(f'{prefix}-update-txt', 'children'),
-        dash.dependencies.Input(f'{prefix}-interval-component', 'n_intervals'),
-    )
-    def update_stamp(n):
-        print(f'Latest update from: {globals.latest_update} UTC')
-        return f'Latest update from: {globals.latest_update} UTC'
-
-    @app.callback(
-        [
-            dash.dependencies.Output(f'{prefix}-battery-soc', 'value'),
-            dash.dependencies.Output(f'{prefix}-battery-soh', 'value'),
-            dash.dependencies.Output(f'{prefix}-12v-soc', 'value'),
-            dash.dependencies.Output(f'{prefix}-range-txt', 'children'),
-            dash.dependencies.Output(f'{prefix}-charging-indicator', 'value'),
-            dash.dependencies.Output(f'{prefix}-charging-indicator', 'label'),
+        [dash.dependencies.Output(f'{prefix}-{cid}', prop) for cid, prop in REFRESH_OUTPUTS]
+        + [
+            dash.dependencies.Output(f'{prefix}-map', 'figure'),
+            dash.dependencies.Output(f'{prefix}-vehicle-select', 'options'),
+            dash.dependencies.Output(f'{prefix}-rendered-store', 'data'),
         ],
         dash.dependencies.Input(f'{prefix}-interval-component', 'n_intervals'),
+        dash.dependencies.Input(f'{prefix}-vehicle-select', 'value'),
+        dash.dependencies.State(f'{prefix}-rendered-store', 'data'),
     )
-    def update_soc(input_value):
-        range_txt = f'Remaining range: {globals.battery_range_num} km'
-        charging_txt = 'Charging in progress' if globals.charging_busy else 'Charger disconnected'
-        return (
-            globals.battery_soc_num,
-            globals.battery_soh_num,
-            globals.battery_12v_soc,
-            range_txt,
-            globals.charging_busy,
-            charging_txt,
-        )
+    def refresh_dashboard(n, vin, rendered):
+        # One round-trip per tick for all widgets; only values that differ from what this
+        # tab already shows are sent back.
+        snapshots = globals.snapshots
+        snap = selected_snapshot(vin)
+        values = dashboard_values(snap)
+        position = [snap.latitude, snap.longitude]
+        options = vehicle_options(snapshots)
+        rendered = rendered or {}
+        if (
+            values == rendered.get('values')
+            and position == rendered.get('position')
+            and options == rendered.get('options')
+        ):
+            raise dash.exceptions.PreventUpdate
+        previous = rendered.get('values') or [None] * len(values)
+        outputs = [dash.no_update if v == p else v for v, p in zip(values, previous)]
+        if position == rendered.get('position'):
+            outputs.append(dash.no_update)
+        elif rendered.get('position') is None:
+            # First refresh of this tab: send the complete (cached) figure
+            outputs.append(create_vehicle_map(snap))
+        else:
+            outputs.append(move_vehicle_marker(snap))
+        outputs.append(options if options != rendered.get('options') else dash.no_update)
+        outputs.append({'values': values, 'position': position, 'options': options})
+        return outputs
 
-    @app.callback(
-        dash.dependencies.Output(f'{prefix}-mileage', 'value'),
-        dash.dependencies.Input(f'{prefix}-interval-component', 'n_intervals'),
+    # Server-Sent Events push the changed values, the interval is only used as fallback
+    # while the stream is not connected
+    app.clientside_callback(
+        f'''
+        function(vin) {{
+            if (window.kiaStream) {{
+                window.kiaStream.close();
+            }}
+            if (!window.EventSource) {{
+                return window.dash_clientside.no_update;
+            }}
+            var source = new EventSource('/api/stream' + (vin ? '?vin=' + encodeURIComponent(vin) : ''));
+            source.onopen = function() {{
+                dash_clientside.set_props('{prefix}-interval-component', {{disabled: true}});
+            }};
+            source.onerror = function() {{
+                dash_clientside.set_props('{prefix}-interval-component', {{disabled: false}});
+            }};
+            source.onmessage = function(e) {{
+                dash_clientside.set_props('{prefix}-push-store', {{data: JSON.parse(e.data)}});
+            }};
+            window.kiaStream = source;
+            return window.dash_clientside.no_update;
+        }}
+        ''',
+        dash.dependencies.Output(f'{prefix}-push-store', 'data'),
+        dash.dependencies.Input(f'{prefix}-vehicle-select', 'value'),
+        prevent_initial_call=False,
     )
-    def update_mileage(input_value):
-        return globals.mileage_num
 
-    @app.callback(
-        dash.dependencies.Output(f'{prefix}-airco-indicator', 'value'),
-        dash.dependencies.Output(f'{prefix}-temperature-txt', 'children'),
-        dash.dependencies.Input(f'{prefix}-interval-component', 'n_intervals'),
-    )
-    def update_aux(input_value):
-        return globals.airo_status, f'{globals.outside_temp} °C'
-
-    @app.callback(
-        dash.dependencies.Output(f'{prefix}-airco-output', 'children'),
-        dash.dependencies.Output(f'{prefix}-log-div', 'children', allow_duplicate=True),
-        dash.dependencies.Input(f'{prefix}-airco-button', 'n_clicks'),
-    )
-    def update_output(n_clicks):
-        cb_trigger = dash.callback_context.triggered[0]['prop_id'].split('.')[0]
-        res = ''
-        if cb_trigger == f'{prefix}-airco-button':
-            res = globals.vm.start_climate(
-                vehicle_id=globals.vehicle_id,
-                options=ClimateRequestOptions(set_temp=20.5, duration=15, defrost=True),
-            )
-            print(f'Airco response: {res}')
-        return '', f'Airco response: {res}'
-
-    @app.callback(
-        dash.dependencies.Output(f'{prefix}-start-charge-output', 'children'),
-        dash.dependencies.Output(f'{prefix}-log-div', 'children', allow_duplicate=True),
-        dash.dependencies.Input(f'{prefix}-start-charge-button', 'n_clicks'),
+    app.clientside_callback(
+        f'''
+        function(payload, rendered, figure) {{
+            var noUpdate = window.dash_clientside.no_update;
+            var outputs = Array({len(REFRESH_OUTPUTS)}).fill(noUpdate);
+            if (!payload) {{
+                return outputs.concat([noUpdate, noUpdate, noUpdate]);
+            }}
+            rendered = Object.assign({{}}, rendered);
+            var values = (rendered.values || Array({len(REFRESH_OUTPUTS)}).fill(null)).slice();
+            Object.keys(payload.values).forEach(function(i) {{
+                outputs[i] = payload.values[i];
+                values[i] = payload.values[i];
+            }});
+            rendered.values = values;
+            var fig = noUpdate;
+            if (payload.position && figure && figure.data && figure.data.length) {{
+                var lat = payload.position[0];
+                var lon = payload.position[1];
+                var data = figure.data.slice();
+                data[0] = Object.assign({{}}, data[0], {{lat: [lat], lon: [lon]}});
+                var layout = Object.assign({{}}, figure.layout);
+                layout.map = Object.assign({{}}, layout.map, {{center: {{lat: lat, lon: lon}}}});
+                fig = Object.assign({{}}, figure, {{data: data, layout: layout}});
+                rendered.position = payload.position;
+            }}
+            var options = noUpdate;
+            if (payload.options) {{
+                options = payload.options;
+                rendered.options = payload.options;
+            }}
+            return outputs.concat([fig, options, rendered]);
+        }}
+        ''',
+        [
+            dash.dependencies.Output(f'{prefix}-{cid}', prop, allow_duplicate=True)
+            for cid, prop in REFRESH_OUTPUTS
+        ]
+        + [
+            dash.dependencies.Output(f'{prefix}-map', 'figure', allow_duplicate=True),
+            dash.dependencies.Output(f'{prefix}-vehicle-select', 'options', allow_duplicate=True),
+            dash.dependencies.Output(f'{prefix}-rendered-store', 'data', allow_duplicate=True),
+        ],
+        dash.dependencies.Input(f'{prefix}-push-store', 'data'),
+        dash.dependencies.State(f'{prefix}-rendered-store', 'data'),
+        dash.dependencies.State(f'{prefix}-map', 'figure'),
+        prevent_initial_call=True,
     )
-    def update_output(n_clicks):
-        cb_trigger = dash.callback_context.triggered[0]['prop_id'].split('.')[0]
-        res = ''
-        if cb_trigger == f'{prefix}-start-charge-button':
-            res = globals.vm.start_charge(vehicle_id=globals.vehicle_id)
-            print(f'start-charge response: {res}')
-        return '', f'start-charge response: {res}'
 
     @app.callback(
-        dash.dependencies.Output(f'{prefix}-stop-charge-output', 'children'),
-        dash.dependencies.Output(f'{prefix}-log-div', 'children', allow_duplicate=True),
-        dash.dependencies.Input(f'{prefix}-stop-charge-button', 'n_clicks'),
+        dash.dependencies.Output(f'{prefix}-jobs-store', 'data'),
+        dash.dependencies.Output(f'{prefix}-job-interval', 'disabled'),
+        [dash.dependencies.Input(f'{prefix}-{cid}', 'n_clicks') for cid in COMMANDS],
+        dash.dependencies.State(f'{prefix}-vehicle-select', 'value'),
+        dash.dependencies.State(f'{prefix}-airco-profile', 'value'),
+        dash.dependencies.State(f'{prefix}-jobs-store', 'data'),
     )
-    def update_output(n_clicks):
+    def send_command(*args):
+        # Commands run in the background, the tab only follows their job ids
+        vin, profile, job_ids = args[-3:]
         cb_trigger = dash.callback_context.triggered[0]['prop_id'].split('.')[0]
-        res = ''
-        if cb_trigger == f'{prefix}-stop-charge-button':
-            res = globals.vm.stop_charge(vehicle_id=globals.vehicle_id)
-            print(f'stop-charge response: {res}')
-        return '', f'stop-charge response: {res}'
+        command = cb_trigger[len(prefix) + 1 :]
+        if command not in COMMANDS:
+            raise dash.exceptions.PreventUpdate
+        label, fn = COMMANDS[command]
+        snap = selected_snapshot(vin)
+        extra = (profile or DEFAULT_PROFILE,) if fn is start_climate else ()
+        job = command_executor.submit(snap.vin, label, snap.vehicle_id, *extra)
+        job_ids = [job_id for job_id in job_ids or [] if job_id != job.id]
+        return job_ids[-(MAX_SHOWN_JOBS - 1) :] + [job.id], False
 
     @app.callback(
-        [
-            dash.dependencies.Output(f'{prefix}-latitude-txt', 'children'),
-            dash.dependencies.Output(f'{prefix}-longitude-txt', 'children'),
-            dash.dependencies.Output(f'{prefix}-car-position-url', 'href'),
-            dash.dependencies.Output(f'{prefix}-map', 'figure'),
-        ],
-        [dash.dependencies.Input(f'{prefix}-interval-component', 'n_intervals')],
-        [dash.dependencies.State(f'{prefix}-map', 'figure')],
+        dash.dependencies.Output(f'{prefix}-log-div', 'children'),
+        dash.dependencies.Output(f'{prefix}-job-interval', 'disabled', allow_duplicate=True),
+        dash.dependencies.Input(f'{prefix}-job-interval', 'n_intervals'),
+        dash.dependencies.Input(f'{prefix}-jobs-store', 'data'),
+        prevent_initial_call=True,
     )
-    def update_position(value, fig):
-        lat_text = f'Latitude: {globals.vehicle_pos_num[0]}'
-        lon_text = f'Longitude: {globals.vehicle_pos_num[1]}'
-        url = f'https://maps.google.com/maps?q={globals.vehicle_pos_num[0]},{globals.vehicle_pos_num[1]}'
-        fig = create_vehicle_map()
-        return lat_text, lon_text, url, fig
+    def show_jobs(n, job_ids):
+        jobs = [job for job in map(command_executor.get, job_ids or []) if job is not None]
+        # Stop polling once every followed command has finished
+        return [html.Div(job_message(job)) for job in jobs], not any(job.active for job in jobs)
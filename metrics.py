@@ -0,0 +1,222 @@
+import os
+import time
+from contextlib import contextmanager
+from threading import Lock, Thread
+
+from flask import Response, request
+
+# Default histogram buckets in seconds, from a fast callback to a slow vendor API call
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Port of the separate metrics endpoint of the leader process under gunicorn, see
+# serve_metrics(). 0 turns it off.
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9100'))
+
+
+def label_text(labels):
+    if not labels:
+        return ''
+    escaped = (
+        (k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for k, v in labels
+    )
+    return '{' + ','.join(f'{k}="{v}"' for k, v in escaped) + '}'
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self._lock = Lock()
+        self._values = {}
+
+    def samples(self):
+        # (suffix, labels, value) tuples
+        with self._lock:
+            return [('', labels, value) for labels, value in self._values.items()]
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for suffix, labels, value in self.samples():
+            lines.append(f'{self.name}{suffix}{label_text(labels)} {value}')
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, collect=None):
+        # collect() returns {labels dict as tuple of pairs: value}, evaluated per scrape
+        super().__init__(name, documentation)
+        self._collect = collect
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[tuple(sorted(labels.items()))] = value
+
+    def samples(self):
+        if self._collect is None:
+            return super().samples()
+        return [('', labels, value) for labels, value in self._collect().items()]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, buckets=BUCKETS):
+        super().__init__(name, documentation)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # Per bucket counts, then the sum and the total count
+                counts = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    @contextmanager
+    def time(self, errors=None, **labels):
+        # Observes the duration of the block, and counts it in `errors` if it raised
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            if errors is not None:
+                errors.inc(**labels)
+            raise
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        with self._lock:
+            values = [(labels, list(counts)) for labels, counts in self._values.items()]
+        samples = []
+        for labels, counts in values:
+            for bound, count in zip(self.buckets, counts):
+                samples.append(('_bucket', labels + (('le', repr(float(bound))),), count))
+            samples.append(('_bucket', labels + (('le', '+Inf'),), counts[-1]))
+            samples.append(('_sum', labels, counts[-2]))
+            samples.append(('_count', labels, counts[-1]))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        return '\n'.join(metric.render() for metric in self._metrics) + '\n'
+
+
+registry = Registry()
+
+VENDOR_API_SECONDS = registry.register(
+    Histogram('kia_vendor_api_call_seconds', 'Latency of vehicle API calls')
+)
+VENDOR_API_ERRORS = registry.register(
+    Counter('kia_vendor_api_errors_total', 'Vehicle API calls that raised')
+)
+VENDOR_API_REJECTED = registry.register(
+    Counter(
+        'kia_vendor_api_rejected_total',
+        'Vehicle API calls refused by the rate limiter or the open circuit breaker',
+    )
+)
+INFLUX_WRITE_SECONDS = registry.register(
+    Histogram('kia_influx_write_seconds', 'Latency of InfluxDB batch writes')
+)
+INFLUX_RECORDS = registry.register(
+    Counter('kia_influx_records_total', 'InfluxDB records by outcome')
+)
+HTTP_REQUEST_SECONDS = registry.register(
+    Histogram('kia_http_request_seconds', 'Latency of HTTP requests and Dash callbacks')
+)
+SCHEDULER_DRIFT_SECONDS = registry.register(
+    Histogram(
+        'kia_scheduler_drift_seconds',
+        'Delay between the planned and actual start of a climate slot',
+        buckets=(0.1, 0.5, 1, 5, 15, 60, 300, 900),
+    )
+)
+POLLS = registry.register(Counter('kia_polls_total', 'Vehicle polls by outcome'))
+LIVE_REFRESHES = registry.register(
+    Counter('kia_live_refreshes_total', 'Refresh from car requests by outcome')
+)
+
+
+def callback_label(callback_map):
+    # First output of a Dash callback request, e.g. main-update-txt.children. The output
+    # comes from the client, anything that is not a registered callback is 'unknown' so it
+    # can't add label values.
+    body = request.get_json(silent=True) or {}
+    output = body.get('output')
+    if not isinstance(output, str) or output not in callback_map:
+        return 'unknown'
+    return output.strip('.').split('...')[0]
+
+
+def register_metrics_route(app):
+    server = app.server
+
+    @server.before_request
+    def start_timer():
+        request.metrics_start = time.perf_counter()
+
+    @server.after_request
+    def observe_request(response):
+        start = getattr(request, 'metrics_start', None)
+        if start is None or request.endpoint == 'metrics':
+            return response
+        if request.path.endswith('/_dash-update-component'):
+            endpoint = 'callback:' + callback_label(app.callback_map)
+        else:
+            endpoint = request.endpoint or 'unknown'
+        HTTP_REQUEST_SECONDS.observe(
+            time.perf_counter() - start, endpoint=endpoint, status=response.status_code
+        )
+        return response
+
+    @server.route('/metrics')
+    def metrics():
+        return Response(registry.render(), content_type=CONTENT_TYPE)
+
+
+def serve_metrics(port):
+    # Every gunicorn worker has its own registry, and only the leader polls the vehicles.
+    # The leader exposes its metrics on a port of its own, so they can always be scraped.
+    from wsgiref.simple_server import WSGIRequestHandler, make_server
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_message(self, *args):
+            pass
+
+    def metrics_app(environ, start_response):
+        start_response('200 OK', [('Content-Type', CONTENT_TYPE)])
+        return [registry.render().encode()]
+
+    httpd = make_server('0.0.0.0', port, metrics_app, handler_class=QuietHandler)
+    Thread(target=httpd.serve_forever, name='metrics', daemon=True).start()
+    return httpd
@@ -0,0 +1,129 @@
+import os
+import time
+from collections import deque
+from threading import Event, Lock
+
+POLL_INTERVAL_ACTIVE = int(os.getenv('POLL_INTERVAL_ACTIVE', str(5 * 60)))
+POLL_INTERVAL_IDLE = int(os.getenv('POLL_INTERVAL_IDLE', str(15 * 60)))
+POLL_INTERVAL_MAX = int(os.getenv('POLL_INTERVAL_MAX', str(4 * 60 * 60)))
+POLL_DELAY_AFTER_COMMAND = int(os.getenv('POLL_DELAY_AFTER_COMMAND', '60'))
+POLL_RETRY_DELAY = int(os.getenv('POLL_RETRY_DELAY', '60'))
+API_CALL_BUDGET = int(os.getenv('API_CALL_BUDGET', '200'))
+
+DAY = 24 * 60 * 60
+
+
+def is_active(snapshot):
+    return snapshot.is_charging or snapshot.is_plugged_in or snapshot.airco_status
+
+
+class AdaptivePollScheduler:
+    # Decides how long the updater sleeps between polls. Polls often while a vehicle is
+    # charging or its climate is on, backs off exponentially while nothing changes, and
+    # never spends more than `budget` vendor API calls in any 24 hour window.
+
+    def __init__(
+        self,
+        active=POLL_INTERVAL_ACTIVE,
+        idle=POLL_INTERVAL_IDLE,
+        maximum=POLL_INTERVAL_MAX,
+        after_command=POLL_DELAY_AFTER_COMMAND,
+        budget=API_CALL_BUDGET,
+        window=DAY,
+    ):
+        self.active = active
+        self.idle = idle
+        self.maximum = maximum
+        self.after_command = after_command
+        self.budget = budget
+        self.window = window
+        self._lock = Lock()
+        self._calls = deque()
+        self._calls_per_poll = 1
+        self._unchanged_polls = 0
+        self._requested_at = None
+        self._wakeup = Event()
+
+    def record_calls(self, count, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            self._calls_per_poll = count
+            self._calls.extend([now] * count)
+
+    def spend(self, count, now=None):
+        # Records `count` calls made outside the polls, e.g. a live refresh, if the budget
+        # allows them. Returns 0, or the seconds until it would.
+        now = time.time() if now is None else now
+        used = self.calls_in_window(now)
+        with self._lock:
+            if used + count > self.budget and self._calls:
+                expire = self._calls[min(used + count - self.budget, used) - 1]
+                return expire + self.window - now
+            self._calls.extend([now] * count)
+        return 0
+
+    def calls_in_window(self, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            while self._calls and self._calls[0] <= now - self.window:
+                self._calls.popleft()
+            return len(self._calls)
+
+    def next_delay(self, snapshots, changed, now=None):
+        now = time.time() if now is None else now
+        if changed:
+            self._unchanged_polls = 0
+        else:
+            self._unchanged_polls += 1
+        if any(is_active(snap) for snap in snapshots):
+            delay = self.active
+        else:
+            delay = min(self.maximum, self.idle * 2 ** max(self._unchanged_polls - 1, 0))
+        return self._within_budget(delay, now)
+
+    def _within_budget(self, delay, now):
+        used = self.calls_in_window(now)
+        with self._lock:
+            needed = self._calls_per_poll
+            if used + needed > self.budget and self._calls:
+                # Wait until enough calls dropped out of the window
+                expire = self._calls[min(used + needed - self.budget, used) - 1]
+                return max(delay, expire + self.window - now)
+            if used > self.budget * 0.75:
+                # Running low, spread what is left evenly
+                return max(delay, self.window * needed / self.budget)
+        return delay
+
+    def request_poll(self, delay=None):
+        # Poll soon, e.g. to pick up the result of a command sent from the dashboard
+        delay = self.after_command if delay is None else delay
+        now = time.time()
+        poll_at = now + self._within_budget(delay, now)
+        with self._lock:
+            if self._requested_at is None or poll_at < self._requested_at:
+                self._requested_at = poll_at
+        self._wakeup.set()
+
+    def take_request(self):
+        # Removes and returns the time a poll was requested for, or None. Used to hand the
+        # request over to the process that runs the updater.
+        with self._lock:
+            requested_at, self._requested_at = self._requested_at, None
+        return requested_at
+
+    def wait(self, delay):
+        deadline = time.time() + delay
+        while True:
+            with self._lock:
+                self._wakeup.clear()
+                if self._requested_at is not None and self._requested_at < deadline:
+                    deadline = self._requested_at
+            timeout = deadline - time.time()
+            if timeout <= 0 or not self._wakeup.wait(timeout):
+                break
+        with self._lock:
+            if self._requested_at is not None and self._requested_at <= time.time():
+                self._requested_at = None
+
+
+poll_scheduler = AdaptivePollScheduler()
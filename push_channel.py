@@ -0,0 +1,50 @@
+import json
+
+from flask import Response, request
+
+import globals
+from main_widget_components import dashboard_values, selected_snapshot, vehicle_options
+from vehicle_snapshot import snapshot_broadcaster
+
+# Seconds between keep-alive comments, keeps proxies from closing an idle stream
+KEEPALIVE = 25
+
+
+def snapshot_events(vin):
+    # Server-Sent Events with the dashboard values that changed since the previous event.
+    # The stream replaces the interval, so it also carries the vehicle dropdown options.
+    sent_values = None
+    sent_position = None
+    sent_options = None
+    version = None
+    while True:
+        new_version = snapshot_broadcaster.wait(version, KEEPALIVE)
+        if new_version == version:
+            yield ': keepalive\n\n'
+            continue
+        version = new_version
+        snap = selected_snapshot(vin)
+        values = dashboard_values(snap)
+        position = [snap.latitude, snap.longitude]
+        options = vehicle_options(globals.snapshots)
+        previous = sent_values or [None] * len(values)
+        payload = {'values': {i: v for i, (v, p) in enumerate(zip(values, previous)) if v != p}}
+        if position != sent_position:
+            payload['position'] = position
+        if options != sent_options:
+            payload['options'] = options
+        sent_values = values
+        sent_position = position
+        sent_options = options
+        if len(payload) > 1 or payload['values']:
+            yield f'data: {json.dumps(payload, default=str)}\n\n'
+
+
+def register_push_routes(server):
+    @server.route('/api/stream')
+    def stream():
+        return Response(
+            snapshot_events(request.args.get('vin')),
+            mimetype='text/event-stream',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+        )
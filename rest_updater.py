@@ -1,147 +1,179 @@
+import logging
 import os
 import time
-
-import influxdb_client
-from influxdb_client import Point
-from influxdb_client.client.write_api import SYNCHRONOUS
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 
 import globals
+from car_status_schema import car_status_line
+from influx_writer import influx_writer
+from metrics import POLLS, Gauge, registry
+from poll_scheduler import POLL_INTERVAL_IDLE, POLL_RETRY_DELAY, poll_scheduler
+from session_detector import feed_snapshot
+from state_cache import load_state, save_state
+from vehicle_client import VendorApiUnavailable, vehicle_manager
+from vehicle_snapshot import VehicleSnapshot, snapshot_broadcaster
+
+POLL_WORKERS = int(os.getenv('POLL_WORKERS', '4'))
+# Opt-in: refresh a car live when its cached data is older than this many seconds. Also
+# the minimum time between two such refreshes, as each one wakes the car.
+FORCE_REFRESH_MAX_AGE = float(os.getenv('FORCE_REFRESH_MAX_AGE', '0'))
+
+_poll_executor = ThreadPoolExecutor(max_workers=POLL_WORKERS, thread_name_prefix='poll')
+_last_poll_at = None
+
+logger = logging.getLogger(__name__)
+
+
+def data_age():
+    now = datetime.now(timezone.utc)
+    return {
+        (('vin', vin),): (now - snap.last_updated_at).total_seconds()
+        for vin, snap in globals.snapshots.items()
+        if snap.last_updated_at is not None
+    }
+
+
+def poll_age():
+    if _last_poll_at is None:
+        return {}
+    return {(): time.time() - _last_poll_at}
 
-INFLUXDB_TOKEN = os.getenv('INFLUXDB_TOKEN', 'default_influxdb_token')
 
-influx_org = 'myorg'
-influx_url = 'http://influxdb:8086'
-influx_client = influxdb_client.InfluxDBClient(
-    url=influx_url, token=INFLUXDB_TOKEN, org=influx_org
+registry.register(
+    Gauge('kia_vehicle_data_age_seconds', 'Age of the latest data reported by the car', data_age)
 )
-influx_bucket = 'mybucket'
-influx_api = influx_client.write_api(write_options=SYNCHRONOUS)
+registry.register(Gauge('kia_poll_age_seconds', 'Time since the last successful poll', poll_age))
+
+
+def tracked_vehicles(vm):
+    # VIN -> vehicle index of the vehicles to poll
+    index = {vehicle.VIN: vehicle for vehicle in vm.vehicles.values()}
+    if '*' in globals.VINS:
+        return index
+    for vin in globals.VINS:
+        if vin not in index:
+            logger.warning('Car %s not found in vehicle list', vin)
+    return {vin: index[vin] for vin in globals.VINS if vin in index}
+
+
+def poll_vehicle(vehicle, previous, force=False):
+    if force:
+        globals.vm.force_refresh_vehicle_state(vehicle.id)
+    else:
+        globals.vm.update_vehicle_with_cached_state(vehicle.id)
+    # Put interesting data in influxDb IF new data is here
+    if previous is None or previous.last_updated_at != vehicle.last_updated_at:
+        line = car_status_line(vehicle)
+        if line is not None:
+            influx_writer.write(line)
+    snap = VehicleSnapshot.from_vehicle(vehicle)
+    feed_snapshot(snap)
+    return snap
+
+
+def publish_snapshots(snapshots):
+    # Every reader sees either the old or the new dict, never a mix
+    globals.snapshots = snapshots
+    primary = snapshots.get(globals.VIN) or next(iter(snapshots.values()), None)
+    if primary is not None:
+        globals.snapshot = primary
+    snapshot_broadcaster.publish()
+
+
+def poll_vehicles():
+    global _last_poll_at
+    vm = vehicle_manager()
+    vm.check_and_refresh_token()
+    vehicles = tracked_vehicles(vm)
+    # One call to validate the token plus one per vehicle
+    poll_scheduler.record_calls(1 + len(vehicles))
+    if not vehicles:
+        return None
+    previous = globals.snapshots
+    futures = {
+        vin: _poll_executor.submit(poll_vehicle, vehicle, previous.get(vin))
+        for vin, vehicle in vehicles.items()
+    }
+    snapshots = dict(previous)
+    retry_after = None
+    for vin, future in futures.items():
+        try:
+            snapshots[vin] = future.result()
+        except VendorApiUnavailable as e:
+            logger.warning('Not polling %s: %s', vin, e)
+            retry_after = max(retry_after or 0, e.retry_after)
+        except Exception as e:
+            logger.error('Error requesting info for %s: %s', vin, e)
+    if retry_after is not None:
+        # Catch up on the refused vehicles as soon as the client allows it
+        poll_scheduler.request_poll(retry_after)
+    publish_snapshots(snapshots)
+    _last_poll_at = time.time()
+    if FORCE_REFRESH_MAX_AGE:
+        refresh_stale(snapshots)
+    try:
+        save_state()
+    except Exception as e:
+        logger.warning('Could not write state cache: %s', e)
+    return snapshots
+
+
+def refresh_stale(snapshots):
+    # live_refresh builds on this module, import it on use
+    from live_refresh import live_refresher
+
+    now = datetime.now(timezone.utc)
+    for vin, snap in snapshots.items():
+        if snap.last_updated_at is None:
+            continue
+        if (now - snap.last_updated_at).total_seconds() > FORCE_REFRESH_MAX_AGE:
+            # A short max age must not wake the car more often than a manual refresh can
+            live_refresher.submit(
+                vin, min_interval=max(live_refresher.min_interval, FORCE_REFRESH_MAX_AGE)
+            )
+
+
+def has_new_data(previous, snapshots):
+    return any(
+        previous.get(vin) is None or previous[vin].last_updated_at != snap.last_updated_at
+        for vin, snap in snapshots.items()
+    )
+
+
+def restore_state():
+    # Serve the last known data right away. The restored last_updated_at also keeps the
+    # first poll from rewriting the same point.
+    snapshots, _ = load_state()
+    if snapshots:
+        publish_snapshots(snapshots)
 
 
 def rest_updater():
+    restore_state()
+    influx_writer.start()
     while True:
+        delay = POLL_INTERVAL_IDLE
         try:
-            if globals.vm is None:
-                print('VM not initialized yet, skipping update')
-                time.sleep(60)
-                continue
-            # Request vehicle info
-            globals.vm.check_and_refresh_token()
-            globals.vm.update_all_vehicles_with_cached_state()
-            if not globals.vm.vehicles:
-                print('No vehicles found for this account!')
+            previous = globals.snapshots
+            snapshots = poll_vehicles()
+            if snapshots is None:
+                logger.warning('No tracked vehicles found for this account')
+                POLLS.inc(outcome='no_vehicles')
                 time.sleep(60)
                 continue
-            for vehicle in globals.vm.vehicles:
-                if globals.vm.vehicles[vehicle].VIN == globals.VIN:
-                    car = globals.vm.vehicles[vehicle]
-                    globals.vehicle_id = car.id
-            if car is None:
-                print('Car not found in vehicle list!')
-                time.sleep(60)
-                continue
-            print(f'Response: {car}')
-            globals.battery_soc_num = car.ev_battery_percentage
-            print(f'Latest soc found: {globals.battery_soc_num}')
-            globals.battery_soh_num = car.ev_battery_soh_percentage
-            print(f'Latest soh found: {globals.battery_soh_num}')
-            globals.battery_12v_soc = car.car_battery_percentage
-            globals.battery_range_num = car.ev_driving_range
-            globals.charging_busy = bool(car.ev_battery_is_plugged_in)
-            globals.mileage_num = car.odometer
-            globals.vehicle_pos_num[0] = car.location_latitude
-            globals.vehicle_pos_num[1] = car.location_longitude
-            update_db = False
-            if globals.latest_update != car.last_updated_at:
-                update_db = True
-                globals.latest_update = car.last_updated_at
-
-            # Put the latest scraped info in memory
-            print(f'Latest range found: {globals.battery_range_num}')
-            print(f'Latest mileage found: {globals.mileage_num}')
-            print(
-                f'Latest position found: latitude: {globals.vehicle_pos_num[0]} longitude: {globals.vehicle_pos_num[1]}'
-            )
-            globals.vehicle_pos['latitude'] = globals.vehicle_pos_num[0]
-            globals.vehicle_pos['longitude'] = globals.vehicle_pos_num[1]
-            globals.outside_temp = car.air_temperature
-            globals.airo_status = bool(car.air_control_is_on)
-
-            # Put interesting data in influxDb IF new data is here
-            if update_db:
-                print(f'Writing data to InfluxDB at t={globals.latest_update}')
-                p = (
-                    Point('car_status')
-                    .tag('car_id', car.id)
-                    .time(car.last_updated_at)
-                    .field('12v_battery_percentage', int(car.car_battery_percentage))
-                    .field('engine_is_running', int(car.engine_is_running))
-                    .field('smart_key_battery_warning_is_on', bool(car.smart_key_battery_warning_is_on))
-                    .field('washer_fluid_warning_is_on', int(car.washer_fluid_warning_is_on))
-                    .field('brake_fluid_warning_is_on', int(car.brake_fluid_warning_is_on))
-                    .field('air_control_is_on', int(car.air_control_is_on))
-                    .field('defrost_is_on', bool(car.defrost_is_on))
-                    .field('steering_wheel_heater_is_on', bool(car.steering_wheel_heater_is_on))
-                    .field('back_window_heater_is_on', bool(car.back_window_heater_is_on))
-                    .field('side_mirror_heater_is_on', bool(car.side_mirror_heater_is_on))
-                    .field(
-                        'front_left_seat_status',
-                        True if car.front_left_seat_status == 'On' else False,
-                    )
-                    .field(
-                        'front_right_seat_status',
-                        True if car.front_right_seat_status == 'On' else False,
-                    )
-                    .field(
-                        'rear_left_seat_status',
-                        True if car.rear_left_seat_status == 'On' else False,
-                    )
-                    .field(
-                        'rear_right_seat_status',
-                        True if car.rear_right_seat_status == 'On' else False,
-                    )
-                    .field('is_locked', bool(car.is_locked))
-                    .field('front_left_door_is_open', int(car.front_left_door_is_open))
-                    .field('front_right_door_is_open', int(car.front_right_door_is_open))
-                    .field('back_left_door_is_open', int(car.back_left_door_is_open))
-                    .field('back_right_door_is_open', int(car.back_right_door_is_open))
-                    .field('trunk_is_open', int(car.trunk_is_open))
-                    .field('hood_is_open', int(car.hood_is_open))
-                    .field('front_left_window_is_open', int(car.front_left_window_is_open))
-                    .field('front_right_window_is_open', int(car.front_right_window_is_open))
-                    .field('back_left_window_is_open', int(car.back_left_window_is_open))
-                    .field('back_right_window_is_open', int(car.back_right_window_is_open))
-                    .field('tire_pressure_all_warning_is_on', bool(car.tire_pressure_all_warning_is_on))
-                    .field(
-                        'tire_pressure_rear_left_warning_is_on',
-                        bool(car.tire_pressure_rear_left_warning_is_on),
-                    )
-                    .field(
-                        'tire_pressure_front_left_warning_is_on',
-                        bool(car.tire_pressure_front_left_warning_is_on),
-                    )
-                    .field(
-                        'tire_pressure_front_right_warning_is_on',
-                        bool(car.tire_pressure_front_right_warning_is_on),
-                    )
-                    .field(
-                        'tire_pressure_rear_right_warning_is_on',
-                        bool(car.tire_pressure_rear_right_warning_is_on),
-                    )
-                    .field('total_power_consumed', int(car.total_power_consumed))
-                    .field('total_power_regenerated', int(car.total_power_regenerated))
-                    .field('power_consumption_30d', int(car.power_consumption_30d))
-                    .field('ev_battery_percentage', int(car.ev_battery_percentage))
-                    .field('ev_battery_soh_percentage', int(car.ev_battery_soh_percentage))
-                    .field('ev_battery_is_charging', bool(car.ev_battery_is_charging))
-                    .field('ev_battery_is_plugged_in', int(car.ev_battery_is_plugged_in))
-                    .field('location_latitude', float(car.location_latitude))
-                    .field('location_longitude', float(car.location_longitude))
-                    .field('odometer', float(car.odometer))
-                    .field('air_temperature', str(car.air_temperature))
-                    .field('ev_driving_range', float(car.ev_driving_range))
-                )
-                influx_api.write(bucket=influx_bucket, record=p)
+            changed = has_new_data(previous, snapshots)
+            POLLS.inc(outcome='changed' if changed else 'unchanged')
+            delay = poll_scheduler.next_delay(snapshots.values(), changed)
+            logger.debug('Polled %d vehicles, next poll in %.0f s', len(snapshots), delay)
+        except VendorApiUnavailable as e:
+            # The vendor client refused to call, try again once it allows calls
+            POLLS.inc(outcome='unavailable')
+            logger.warning('Not polling: %s, retrying in %.0f s', e, e.retry_after)
+            delay = max(e.retry_after, 1)
         except Exception as e:
-            print(f'Error requesting info: {e}')
-        time.sleep(15 * 60)
+            # Repeated failures open the circuit breaker, which then sets the pace
+            POLLS.inc(outcome='error')
+            logger.error('Error requesting info: %s', e)
+            delay = POLL_RETRY_DELAY
+        poll_scheduler.wait(delay)
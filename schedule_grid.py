@@ -0,0 +1,98 @@
+import re
+from datetime import datetime, timedelta
+
+# The weekly grid of the climate schedule: one cell per day and 15 minute slot
+DAYS = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+START_HOUR = 6
+END_HOUR = 23
+SLOT_MINUTES = 15
+
+
+def generate_time_slots(start_hour, end_hour, slot_minutes):
+    slots = []
+    t = datetime(2000, 1, 1, start_hour, 0)
+    end = datetime(2000, 1, 1, end_hour, 0)
+    while t < end:
+        slots.append(t.strftime('%H:%M'))
+        t += timedelta(minutes=slot_minutes)
+    return slots
+
+
+TIME_SLOTS = generate_time_slots(START_HOUR, END_HOUR, SLOT_MINUTES)
+DAY_INDEX = {d: i for i, d in enumerate(DAYS)}
+TIME_INDEX = {t: i for i, t in enumerate(TIME_SLOTS)}
+GRID_CELLS = len(DAYS) * len(TIME_SLOTS)
+
+
+def cell_bit(day_idx, time_idx):
+    # Bit of a cell in a schedule bitmap, days are stored one after the other
+    return 1 << (day_idx * len(TIME_SLOTS) + time_idx)
+
+
+def bitmap_cells(bitmap):
+    # (day index, time index) of every set bit
+    n_times = len(TIME_SLOTS)
+    cells = []
+    while bitmap:
+        low = bitmap & -bitmap
+        cells.append(divmod(low.bit_length() - 1, n_times))
+        bitmap ^= low
+    return cells
+
+
+DAY_GROUPS = {
+    'daily': range(7),
+    'everyday': range(7),
+    'weekdays': range(5),
+    'weekends': range(5, 7),
+}
+TEMPLATE_RE = re.compile(r'^\s*([a-z, ]+?)\s+(\d{1,2}:\d{2})(?:\s*-\s*(\d{1,2}:\d{2}))?\s*$')
+
+
+def template_days(text):
+    days = set()
+    for part in re.split(r'[,\s]+', text.strip()):
+        if not part:
+            continue
+        if part in DAY_GROUPS:
+            days.update(DAY_GROUPS[part])
+            continue
+        matches = [i for i, d in enumerate(DAYS) if len(part) >= 2 and d.lower().startswith(part)]
+        if len(matches) != 1:
+            raise ValueError(f'Unknown day {part!r}')
+        days.add(matches[0])
+    return sorted(days)
+
+
+def normalize_label(label):
+    hours, minutes = label.split(':')
+    return f'{int(hours):02d}:{minutes}'
+
+
+def template_time_index(label):
+    index = TIME_INDEX.get(normalize_label(label))
+    if index is None:
+        raise ValueError(
+            f'{label} is not a {SLOT_MINUTES} minute slot between {TIME_SLOTS[0]} and {TIME_SLOTS[-1]}'
+        )
+    return index
+
+
+def parse_template(text):
+    # Cells of a recurring template such as 'weekdays 07:30', 'sat,sun 09:00' or
+    # 'daily 06:00-07:00' (end exclusive). Raises ValueError with a readable message.
+    match = TEMPLATE_RE.match(text.lower())
+    if not match:
+        raise ValueError('Use "<days> HH:MM" or "<days> HH:MM-HH:MM", e.g. "weekdays 07:30"')
+    days_text, start, end = match.groups()
+    first = template_time_index(start)
+    if end is None:
+        times = [first]
+    elif normalize_label(end) == f'{END_HOUR:02d}:00':
+        times = range(first, len(TIME_SLOTS))
+    else:
+        last = template_time_index(end)
+        if last <= first:
+            raise ValueError('The end time must be after the start time')
+        times = range(first, last)
+    return {(day, t) for day in template_days(days_text) for t in times}
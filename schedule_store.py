@@ -0,0 +1,317 @@
+import fcntl
+import json
+import logging
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+from threading import RLock
+
+from climate_profiles import DEFAULT_PROFILE, DEFAULT_PROFILES, ClimateProfile
+from schedule_grid import DAY_INDEX, DAYS, TIME_INDEX, TIME_SLOTS, bitmap_cells, cell_bit
+
+SCHEDULE_FILE = os.getenv('SCHEDULE_FILE', 'scheduled_slots.json')
+
+logger = logging.getLogger(__name__)
+
+
+# Version of the on-disk format. Version 1 was a JSON list of [day, time, timezone],
+# version 2 had one bitmap per timezone and no climate profiles.
+FORMAT_VERSION = 3
+
+
+def slot_cell(slot):
+    # (timezone, bit) of a (day, time, timezone) slot, None if it is not on the grid
+    if len(slot) != 3:
+        return None
+    day_idx = DAY_INDEX.get(slot[0])
+    time_idx = TIME_INDEX.get(slot[1])
+    if day_idx is None or time_idx is None:
+        return None
+    return slot[2], cell_bit(day_idx, time_idx)
+
+
+def union(layers):
+    # Timezone -> bitmap of every scheduled slot, whatever its profile
+    bitmaps = {}
+    for tz, profiles in layers.items():
+        bitmap = 0
+        for layer in profiles.values():
+            bitmap |= layer
+        bitmaps[tz] = bitmap
+    return bitmaps
+
+
+def bitmaps_to_slots(bitmaps):
+    return frozenset(
+        (DAYS[day_idx], TIME_SLOTS[time_idx], tz)
+        for tz, bitmap in bitmaps.items()
+        for day_idx, time_idx in bitmap_cells(bitmap)
+    )
+
+
+def slots_to_bitmaps(slots):
+    bitmaps = {}
+    for slot in slots:
+        cell = slot_cell(tuple(slot))
+        if cell is None:
+            logger.warning('Dropping schedule slot %s, it is not on the schedule grid', slot)
+            continue
+        tz, bit = cell
+        bitmaps[tz] = bitmaps.get(tz, 0) | bit
+    return bitmaps
+
+
+class ScheduleStore:
+    # In-memory copy of the climate schedule, shared by the UI and the scheduler thread.
+    # Every worker process has its own copy of the same file. An edit re-reads the file,
+    # applies the change and writes it back while holding an exclusive flock, so edits from
+    # different processes never overwrite each other. Edits made by someone else are
+    # picked up based on the file's mtime.
+    #
+    # The schedule is kept as bitmaps of the 7 x 68 grid per timezone and climate profile,
+    # so testing a slot is O(1) and a bulk edit is a couple of integer operations. A slot
+    # belongs to exactly one profile. The dicts are replaced on every change, never mutated.
+
+    def __init__(self, path, check_interval=5.0):
+        self.path = path
+        directory, name = os.path.split(os.path.abspath(path))
+        # The schedule file itself is replaced on every write, so lock a file next to it
+        self.lock_path = os.path.join(directory, f'.{name}.lock')
+        self.check_interval = check_interval
+        self._lock = RLock()
+        self._layers = {}
+        self._bitmaps = {}
+        self._slots = frozenset()
+        self._profiles = DEFAULT_PROFILES
+        self._mtime = None
+        self._checked_at = 0.0
+        self._subscribers = []
+        self._load()
+
+    def slots(self):
+        self.reload_if_changed()
+        return self._slots
+
+    def bitmaps(self):
+        # Timezone -> bitmap, see schedule_grid.cell_bit(). Callers must not mutate it.
+        self.reload_if_changed()
+        return self._bitmaps
+
+    def profiles(self):
+        # Name -> ClimateProfile. Callers must not mutate it.
+        self.reload_if_changed()
+        return self._profiles
+
+    def climate_profile(self, name):
+        profile = self._profiles.get(name)
+        if profile is None:
+            logger.warning('Unknown climate profile %r, using %r', name, DEFAULT_PROFILE)
+            profile = self._profiles[DEFAULT_PROFILE]
+        return profile
+
+    def profile_of(self, slot):
+        # Name of the climate profile of a scheduled slot, None if it is not scheduled
+        cell = slot_cell(tuple(slot))
+        if cell is None:
+            return None
+        tz, bit = cell
+        for name, bitmap in self._layers.get(tz, {}).items():
+            if bitmap & bit:
+                return name
+        return None
+
+    def is_scheduled(self, slot):
+        cell = slot_cell(tuple(slot))
+        if cell is None:
+            return False
+        tz, bit = cell
+        return bool(self._bitmaps.get(tz, 0) & bit)
+
+    def set_slots(self, slots, profile=DEFAULT_PROFILE):
+        bitmaps = slots_to_bitmaps(slots)
+        return self._replace(lambda layers: {tz: {profile: b} for tz, b in bitmaps.items()}) > 0
+
+    def update(self, add=(), remove=(), profile=DEFAULT_PROFILE):
+        # Adds and removes any number of slots as one change: one notification and one
+        # write. Added slots use the given climate profile, also when they were already
+        # scheduled with another one. Returns the number of slots that actually changed.
+        add = slots_to_bitmaps(add)
+        remove = slots_to_bitmaps(remove)
+
+        def edit(layers):
+            layers = dict(layers)
+            for tz in remove.keys() | add.keys():
+                cleared = remove.get(tz, 0) | add.get(tz, 0)
+                profiles = {
+                    name: bitmap & ~cleared for name, bitmap in layers.get(tz, {}).items()
+                }
+                if tz in add:
+                    profiles[profile] = profiles.get(profile, 0) | add[tz]
+                layers[tz] = profiles
+            return layers
+
+        return self._replace(edit)
+
+    def toggle(self, slot, profile=DEFAULT_PROFILE):
+        # Returns True if the slot got scheduled, False if it got unscheduled
+        cell = slot_cell(tuple(slot))
+        if cell is None:
+            raise ValueError(f'{slot} is not on the schedule grid')
+        tz, bit = cell
+        added = []
+
+        def edit(layers):
+            profiles = layers.get(tz, {})
+            if any(bitmap & bit for bitmap in profiles.values()):
+                added.append(False)
+                profiles = {name: bitmap & ~bit for name, bitmap in profiles.items()}
+            else:
+                added.append(True)
+                profiles = {**profiles, profile: profiles.get(profile, 0) | bit}
+            return {**layers, tz: profiles}
+
+        self._replace(edit)
+        return added[0]
+
+    def _replace(self, edit):
+        # Applies edit(layers) -> new layers to the current file contents and writes the
+        # result, all under the file lock. Returns how many slots changed.
+        with self._lock, self._file_lock():
+            before = self._slots
+            self._load()
+            old = self._layers
+            layers = {}
+            for tz, profiles in edit(old).items():
+                profiles = {name: bitmap for name, bitmap in profiles.items() if bitmap}
+                if profiles:
+                    layers[tz] = profiles
+            changed = 0
+            for tz in layers.keys() | old.keys():
+                new_profiles = layers.get(tz, {})
+                old_profiles = old.get(tz, {})
+                diff = 0
+                for name in new_profiles.keys() | old_profiles.keys():
+                    diff |= new_profiles.get(name, 0) ^ old_profiles.get(name, 0)
+                changed += bin(diff).count('1')
+            if changed:
+                self._set_layers(layers)
+                try:
+                    self._write(layers, self._profiles)
+                except OSError as e:
+                    logger.error('Could not write schedule to %s: %s', self.path, e)
+            slots = self._slots
+        # Also tells about edits of other processes picked up by the reload
+        if slots != before:
+            self._notify(slots)
+        return changed
+
+    @contextmanager
+    def _file_lock(self):
+        fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+    def _set_layers(self, layers):
+        self._layers = layers
+        self._bitmaps = union(layers)
+        self._slots = bitmaps_to_slots(self._bitmaps)
+
+    def subscribe(self, callback):
+        # callback(slots) is called from the thread that made the change
+        with self._lock:
+            self._subscribers.append(callback)
+
+    def reload_if_changed(self):
+        now = time.monotonic()
+        if now - self._checked_at < self.check_interval:
+            return
+        self._checked_at = now
+        with self._lock:
+            if self._file_mtime() == self._mtime:
+                return
+            self._load()
+            slots = self._slots
+        self._notify(slots)
+
+    def _notify(self, slots):
+        for callback in list(self._subscribers):
+            try:
+                callback(slots)
+            except Exception as e:
+                logger.error('Schedule subscriber failed: %s', e)
+
+    def _file_mtime(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+
+    def _load(self):
+        self._mtime = self._file_mtime()
+        try:
+            with open(self.path, 'r') as f:
+                data = f.read()
+            data = json.loads(data) if data.strip() else {}
+            profiles = DEFAULT_PROFILES
+            if isinstance(data, list):
+                # Version 1 file, it is rewritten in the current format on the next write
+                layers = {tz: {DEFAULT_PROFILE: b} for tz, b in slots_to_bitmaps(data).items()}
+            else:
+                layers = {}
+                for tz, value in data.get('timezones', {}).items():
+                    if isinstance(value, str):
+                        # Version 2, a single bitmap per timezone
+                        value = {DEFAULT_PROFILE: value}
+                    layers[tz] = {name: int(bitmap, 16) for name, bitmap in value.items()}
+                if data.get('profiles'):
+                    profiles = {
+                        name: ClimateProfile.from_dict(profile)
+                        for name, profile in data['profiles'].items()
+                    }
+                    profiles.setdefault(DEFAULT_PROFILE, DEFAULT_PROFILES[DEFAULT_PROFILE])
+            self._set_layers(layers)
+            self._profiles = profiles
+        except FileNotFoundError:
+            self._set_layers({})
+            self._profiles = DEFAULT_PROFILES
+        except Exception as e:
+            # Possibly caught halfway an in-place write, keep the current slots and retry
+            logger.warning('Could not read schedule from %s: %s', self.path, e)
+            self._mtime = None
+
+    def _write(self, layers, profiles):
+        data = json.dumps(
+            {
+                'format': FORMAT_VERSION,
+                'profiles': {name: profile.to_dict() for name, profile in sorted(profiles.items())},
+                'timezones': {
+                    tz: {name: f'{bitmap:x}' for name, bitmap in sorted(layer.items())}
+                    for tz, layer in sorted(layers.items())
+                },
+            }
+        )
+        directory = os.path.dirname(os.path.abspath(self.path))
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.schedule-')
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.path)
+            except OSError:
+                os.unlink(tmp_path)
+                raise
+        except OSError:
+            # A bind-mounted file (see docker-compose.yml) can't be replaced by a rename,
+            # overwrite it in place instead
+            with open(self.path, 'w') as f:
+                f.write(data)
+        self._mtime = self._file_mtime()
+
+
+schedule_store = ScheduleStore(SCHEDULE_FILE)
@@ -0,0 +1,193 @@
+import argparse
+import logging
+import os
+
+import globals
+from car_status_schema import as_float, as_int, compile_fields, escape_tag, timestamp_ns
+from history_query import query_api
+from influx_writer import (
+    INFLUXDB_TOKEN,
+    InfluxWriter,
+    influx_bucket,
+    influx_org,
+    influx_spool_file,
+    influx_url,
+    influx_writer,
+)
+from vehicle_snapshot import VehicleSnapshot
+
+BATTERY_CAPACITY_KWH = float(os.getenv('BATTERY_CAPACITY_KWH', '81.4'))
+# The backfill runs next to the app, so it spools to its own file. Whatever is left in
+# it is written by the next backfill.
+BACKFILL_SPOOL_FILE = os.getenv(
+    'BACKFILL_SPOOL_FILE',
+    os.path.join(os.path.dirname(influx_spool_file), 'influx_backfill_spool.lp'),
+)
+
+
+class Trip:
+    __slots__ = ('start', 'end')
+
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+
+    @property
+    def distance_km(self):
+        return self.end.mileage - self.start.mileage
+
+    @property
+    def duration_s(self):
+        return (self.end.last_updated_at - self.start.last_updated_at).total_seconds()
+
+    @property
+    def energy_kwh(self):
+        return (self.start.battery_soc - self.end.battery_soc) / 100 * BATTERY_CAPACITY_KWH
+
+
+class ChargingSession(Trip):
+    __slots__ = ()
+
+    @property
+    def energy_kwh(self):
+        return (self.end.battery_soc - self.start.battery_soc) / 100 * BATTERY_CAPACITY_KWH
+
+    @property
+    def average_kw(self):
+        hours = self.duration_s / 3600
+        return self.energy_kwh / hours if hours > 0 else None
+
+
+TRIP_FIELDS = (
+    ('distance_km', 'distance_km', as_float),
+    ('duration_s', 'duration_s', as_int),
+    ('energy_kwh', 'energy_kwh', as_float),
+    ('start_latitude', 'start.latitude', as_float),
+    ('start_longitude', 'start.longitude', as_float),
+    ('end_latitude', 'end.latitude', as_float),
+    ('end_longitude', 'end.longitude', as_float),
+    ('start_soc', 'start.battery_soc', as_float),
+    ('end_soc', 'end.battery_soc', as_float),
+)
+
+CHARGING_SESSION_FIELDS = (
+    ('duration_s', 'duration_s', as_int),
+    ('energy_kwh', 'energy_kwh', as_float),
+    ('average_kw', 'average_kw', as_float),
+    ('start_soc', 'start.battery_soc', as_float),
+    ('end_soc', 'end.battery_soc', as_float),
+)
+
+extract_trip = compile_fields(TRIP_FIELDS)
+extract_charging_session = compile_fields(CHARGING_SESSION_FIELDS)
+
+
+def session_line(measurement, extract, session):
+    fields = extract(session)
+    if not fields:
+        return None
+    return (
+        f'{measurement},car_id={escape_tag(session.start.vehicle_id)} {fields} '
+        f'{timestamp_ns(session.start.last_updated_at)}'
+    )
+
+
+class SessionDetector:
+    # Turns successive snapshots of one vehicle into trips and charging sessions. Only the
+    # previous snapshot and the start of the open trip and session are kept.
+
+    def __init__(self, emit):
+        self._emit = emit
+        self._previous = None
+        self._trip_start = None
+        self._charge_start = None
+
+    def feed(self, snap):
+        previous = self._previous
+        if snap.last_updated_at is None or snap.mileage is None:
+            return
+        if previous is not None and snap.last_updated_at <= previous.last_updated_at:
+            # Same poll result seen again
+            return
+        if previous is not None:
+            if snap.mileage > previous.mileage:
+                if self._trip_start is None:
+                    self._trip_start = previous
+            elif self._trip_start is not None:
+                # Odometer stopped moving, the trip ended at the previous snapshot
+                trip = Trip(self._trip_start, previous)
+                self._trip_start = None
+                self.emit(session_line('trips', extract_trip, trip))
+        if snap.is_charging and self._charge_start is None:
+            self._charge_start = snap
+        elif not snap.is_charging and self._charge_start is not None:
+            session = ChargingSession(self._charge_start, snap)
+            self._charge_start = None
+            self.emit(session_line('charging_sessions', extract_charging_session, session))
+        self._previous = snap
+
+    def emit(self, line):
+        if line is not None:
+            self._emit(line)
+
+
+# VIN -> detector of the vehicles polled by rest_updater
+session_detectors = {}
+
+
+def feed_snapshot(snap):
+    detector = session_detectors.get(snap.vin)
+    if detector is None:
+        detector = session_detectors[snap.vin] = SessionDetector(influx_writer.write)
+    detector.feed(snap)
+
+
+BACKFILL_FLUX = '''from(bucket: "{bucket}")
+  |> range(start: {start})
+  |> filter(fn: (r) => r._measurement == "car_status")
+  |> filter(fn: (r) => r._field == "odometer" or r._field == "ev_battery_percentage"
+      or r._field == "ev_battery_is_charging" or r._field == "location_latitude"
+      or r._field == "location_longitude")
+  |> pivot(rowKey: ["_time"], columnKey: ["_field"], valueColumn: "_value")
+  |> group(columns: ["car_id"])
+  |> sort(columns: ["_time"])
+'''
+
+
+def backfill(start):
+    # Replays stored car_status points through fresh detectors. Sessions are written
+    # with the same timestamps as a live run, so running this twice is harmless.
+    detectors = {}
+    writer = InfluxWriter(influx_url, INFLUXDB_TOKEN, influx_org, influx_bucket, BACKFILL_SPOOL_FILE)
+    writer.start()
+    for record in query_api().query_stream(BACKFILL_FLUX.format(bucket=influx_bucket, start=start)):
+        car_id = record.values.get('car_id')
+        detector = detectors.get(car_id)
+        if detector is None:
+            detector = detectors[car_id] = SessionDetector(writer.write)
+        detector.feed(
+            VehicleSnapshot(
+                vehicle_id=car_id,
+                last_updated_at=record.get_time(),
+                mileage=record.values.get('odometer'),
+                battery_soc=record.values.get('ev_battery_percentage'),
+                is_charging=bool(record.values.get('ev_battery_is_charging')),
+                latitude=record.values.get('location_latitude'),
+                longitude=record.values.get('location_longitude'),
+            )
+        )
+    writer.stop(timeout=60)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=globals.LOG_LEVEL, format=globals.LOG_FORMAT)
+    parser = argparse.ArgumentParser(description='Derive trips and charging sessions from history')
+    parser.add_argument(
+        '--backfill',
+        default='30d',
+        metavar='DURATION',
+        help='How far back to look, e.g. 90d or 12h (default 30d)',
+    )
+    # A leading minus, as in Flux, is also accepted when attached: --backfill=-90d
+    duration = parser.parse_args().backfill
+    backfill(duration if duration.startswith('-') else f'-{duration}')
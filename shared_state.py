@@ -0,0 +1,354 @@
+import fcntl
+import json
+import logging
+import os
+import sqlite3
+import time
+from concurrent.futures import TimeoutError as FutureTimeout
+from datetime import datetime, timezone
+from threading import Thread, local
+
+import climate_scheduler
+import globals
+from command_executor import FAILED, QUEUED, Job, command_executor
+from live_refresh import live_refresher
+from poll_scheduler import poll_scheduler
+from rest_updater import publish_snapshots
+from schedule_store import schedule_store
+from vehicle_client import VendorApiTimeout, VendorApiUnavailable
+from vehicle_snapshot import VehicleSnapshot, snapshot_broadcaster
+
+SHARED_STATE_DIR = os.getenv('SHARED_STATE_DIR', '/tmp/kia_dashboard')
+SYNC_INTERVAL = float(os.getenv('SHARED_STATE_SYNC_INTERVAL', '1.0'))
+# Finished command jobs are kept this long, so every tab can show their outcome
+JOB_KEEP_SECONDS = 60 * 60
+# How often a worker checks whether the leader finished a live refresh it asked for
+REFRESH_CHECK_INTERVAL = 0.25
+
+# Exceptions of a live refresh by name, so the asking worker can raise the same kind
+REFRESH_ERRORS = {
+    'unknown': LookupError,
+    'unavailable': VendorApiUnavailable,
+    'timeout': VendorApiTimeout,
+    'error': RuntimeError,
+}
+
+logger = logging.getLogger(__name__)
+
+
+class SharedState:
+    # Snapshots, poll requests and command jobs shared between the worker processes of one
+    # host, kept in a small SQLite database. Only the leader writes snapshots, every write
+    # bumps a version so the other workers can cheaply check for news. Any worker can queue
+    # a command job or a live refresh, the leader takes and runs them and writes back
+    # their outcome.
+
+    def __init__(self, path):
+        self.path = path
+        self._local = local()
+
+    def _db(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('CREATE TABLE IF NOT EXISTS snapshots (vin TEXT PRIMARY KEY, data TEXT)')
+            db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value REAL)')
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, vin TEXT, command TEXT, '
+                'args TEXT, status TEXT, result TEXT, created_at REAL, finished_at REAL, '
+                'taken INTEGER DEFAULT 0)'
+            )
+            # Last fire time of every climate slot, slot as a JSON [day, time, timezone]
+            db.execute('CREATE TABLE IF NOT EXISTS fired (slot TEXT PRIMARY KEY, fired_at REAL)')
+            # One row per vehicle, the latest live refresh asked for and its outcome
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS refreshes (vin TEXT PRIMARY KEY, requested_at REAL, '
+                'taken INTEGER, finished_at REAL, error TEXT, message TEXT, retry_after REAL, '
+                'snapshot TEXT)'
+            )
+            self._local.db = db
+        return db
+
+    def _get(self, db, key):
+        row = db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set(self, db, key, value):
+        db.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+
+    def version(self):
+        return self._get(self._db(), 'version') or 0
+
+    def store_snapshots(self, snapshots):
+        db = self._db()
+        with db:
+            db.execute('BEGIN IMMEDIATE')
+            db.execute('DELETE FROM snapshots')
+            db.executemany(
+                'INSERT INTO snapshots (vin, data) VALUES (?, ?)',
+                [(vin, json.dumps(snap.to_dict())) for vin, snap in snapshots.items()],
+            )
+            self._set(db, 'version', (self._get(db, 'version') or 0) + 1)
+
+    def load_snapshots(self):
+        # Returns (version, snapshots), read in one transaction
+        db = self._db()
+        with db:
+            db.execute('BEGIN')
+            version = self._get(db, 'version') or 0
+            rows = db.execute('SELECT vin, data FROM snapshots').fetchall()
+        return version, {vin: VehicleSnapshot.from_dict(json.loads(data)) for vin, data in rows}
+
+    def request_poll(self, poll_at):
+        db = self._db()
+        with db:
+            db.execute('BEGIN IMMEDIATE')
+            current = self._get(db, 'poll_at')
+            if current is None or poll_at < current:
+                self._set(db, 'poll_at', poll_at)
+
+    def take_poll_request(self):
+        db = self._db()
+        with db:
+            db.execute('BEGIN IMMEDIATE')
+            poll_at = self._get(db, 'poll_at')
+            if poll_at is not None:
+                db.execute("DELETE FROM meta WHERE key = 'poll_at'")
+        return poll_at
+
+    def submit_job(self, vin, command, args):
+        # Queues a command for the leader, or returns the same command with the same
+        # arguments that is still pending for the vehicle
+        args = json.dumps(list(args))
+        db = self._db()
+        with db:
+            db.execute('BEGIN IMMEDIATE')
+            db.execute(
+                'DELETE FROM jobs WHERE finished_at < ?', (time.time() - JOB_KEEP_SECONDS,)
+            )
+            row = db.execute(
+                'SELECT * FROM jobs WHERE vin = ? AND command = ? AND args = ? '
+                'AND finished_at IS NULL',
+                (vin, command, args),
+            ).fetchone()
+            if row is not None:
+                return self._job(row)
+            job = Job(vin, command, json.loads(args))
+            db.execute(
+                'INSERT INTO jobs (id, vin, command, args, status, created_at) VALUES (?, ?, ?, ?, ?, ?)',
+                (job.id, vin, command, args, job.status, job.created_at),
+            )
+        return job
+
+    def get_job(self, job_id):
+        row = self._db().execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return None if row is None else self._job(row)
+
+    def take_jobs(self):
+        # Returns [(job id, vin, command, args)] of the jobs no leader took yet
+        db = self._db()
+        with db:
+            db.execute('BEGIN IMMEDIATE')
+            rows = db.execute(
+                'SELECT id, vin, command, args FROM jobs WHERE taken = 0 ORDER BY created_at'
+            ).fetchall()
+            db.execute('UPDATE jobs SET taken = 1 WHERE taken = 0')
+        return [(job_id, vin, command, json.loads(args)) for job_id, vin, command, args in rows]
+
+    def update_job(self, job_id, job):
+        result = None if job.result is None else str(job.result)
+        with self._db() as db:
+            db.execute(
+                'UPDATE jobs SET status = ?, result = ?, finished_at = ? WHERE id = ?',
+                (job.status, result, job.finished_at, job_id),
+            )
+
+    def fail_orphaned_jobs(self):
+        # Jobs a previous leader took but did not finish died with it. They may or may
+        # not have reached the car, so they are failed rather than run again.
+        with self._db() as db:
+            db.execute(
+                'UPDATE jobs SET status = ?, result = ?, finished_at = ? '
+                'WHERE taken = 1 AND finished_at IS NULL',
+                (FAILED, 'the worker running it stopped', time.time()),
+            )
+            # A live refresh can safely run again
+            db.execute('UPDATE refreshes SET taken = 0 WHERE taken = 1 AND finished_at IS NULL')
+
+    def refresh(self, vin, timeout=None):
+        # Asks the leader for a live refresh of `vin` and waits for it. Returns the new
+        # snapshot or raises what the refresh raised, FutureTimeout after `timeout` seconds.
+        deadline = None if timeout is None else time.monotonic() + timeout
+        db = self._db()
+        with db:
+            db.execute('BEGIN IMMEDIATE')
+            row = db.execute(
+                'SELECT requested_at, finished_at FROM refreshes WHERE vin = ?', (vin,)
+            ).fetchone()
+            if row is not None and row[1] is None:
+                # Join the refresh someone else asked for
+                requested_at = row[0]
+            else:
+                requested_at = time.time()
+                db.execute(
+                    'INSERT OR REPLACE INTO refreshes (vin, requested_at, taken) VALUES (?, ?, 0)',
+                    (vin, requested_at),
+                )
+        while True:
+            row = db.execute(
+                'SELECT finished_at, error, message, retry_after, snapshot FROM refreshes '
+                'WHERE vin = ?',
+                (vin,),
+            ).fetchone()
+            if row is not None and row[0] is not None and row[0] >= requested_at:
+                break
+            if deadline is not None and time.monotonic() >= deadline:
+                raise FutureTimeout()
+            time.sleep(REFRESH_CHECK_INTERVAL)
+        _, error, message, retry_after, snapshot = row
+        if error == 'unavailable':
+            raise VendorApiUnavailable(message, retry_after)
+        if error is not None:
+            raise REFRESH_ERRORS.get(error, RuntimeError)(message)
+        return VehicleSnapshot.from_dict(json.loads(snapshot))
+
+    def take_refreshes(self):
+        # Returns the VINs of the live refreshes no leader took yet
+        db = self._db()
+        with db:
+            db.execute('BEGIN IMMEDIATE')
+            rows = db.execute('SELECT vin FROM refreshes WHERE taken = 0').fetchall()
+            db.execute('UPDATE refreshes SET taken = 1 WHERE taken = 0')
+        return [vin for vin, in rows]
+
+    def finish_refresh(self, vin, future):
+        error = message = retry_after = snapshot = None
+        try:
+            snapshot = json.dumps(future.result().to_dict())
+        except Exception as e:
+            error = next(
+                (name for name, kind in REFRESH_ERRORS.items() if isinstance(e, kind)), 'error'
+            )
+            message = str(e)
+            retry_after = getattr(e, 'retry_after', None)
+        with self._db() as db:
+            db.execute(
+                'UPDATE refreshes SET finished_at = ?, error = ?, message = ?, retry_after = ?, '
+                'snapshot = ? WHERE vin = ?',
+                (time.time(), error, message, retry_after, snapshot, vin),
+            )
+
+    def fired_slots(self):
+        # Slot -> last (UTC) time the climate scheduler fired it
+        rows = self._db().execute('SELECT slot, fired_at FROM fired').fetchall()
+        return {
+            tuple(json.loads(slot)): datetime.fromtimestamp(fired_at, timezone.utc)
+            for slot, fired_at in rows
+        }
+
+    def record_fired(self, fire_times):
+        with self._db() as db:
+            db.executemany(
+                'INSERT OR REPLACE INTO fired (slot, fired_at) VALUES (?, ?)',
+                [(json.dumps(slot), t.timestamp()) for slot, t in fire_times.items()],
+            )
+
+    def _job(self, row):
+        job_id, vin, command, args, status, result, created_at, finished_at, _ = row
+        job = Job(vin, command, json.loads(args), job_id)
+        job.status = status or QUEUED
+        job.result = result
+        job.created_at = created_at
+        job.finished_at = finished_at
+        return job
+
+
+class LeaderLock:
+    # Whoever holds the flock on `path` is the leader. The kernel drops the lock when the
+    # process dies, so another worker takes over on its next attempt.
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+
+    def try_acquire(self):
+        if self._fd is not None:
+            return True
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self._fd = fd
+        return True
+
+
+def sync_worker(state, leader_lock, start_leader):
+    # Runs in every worker. The leader starts the background threads, runs the queued
+    # command jobs and live refreshes and publishes its snapshots; the other workers mirror
+    # them and forward poll requests to the leader.
+    leader = False
+    seen = None
+    running = {}
+    refreshing = {}
+    while True:
+        try:
+            if not leader and leader_lock.try_acquire():
+                leader = True
+                seen = None
+                logger.info('Worker %d is the leader, starting the updater and scheduler', os.getpid())
+                state.fail_orphaned_jobs()
+                start_leader()
+            # Schedule edits can come from any worker, all of them share the file
+            schedule_store.reload_if_changed()
+            if leader:
+                poll_at = state.take_poll_request()
+                if poll_at is not None:
+                    poll_scheduler.request_poll(max(poll_at - time.time(), 0))
+                for job_id, vin, command, args in state.take_jobs():
+                    running[job_id] = command_executor.execute(vin, command, args, job_id=job_id)
+                for vin in state.take_refreshes():
+                    refreshing[vin] = live_refresher.submit(vin)
+                version = snapshot_broadcaster.wait(seen, SYNC_INTERVAL)
+                if version != seen:
+                    seen = version
+                    state.store_snapshots(globals.snapshots)
+                for job_id, job in list(running.items()):
+                    state.update_job(job_id, job)
+                    if not job.active:
+                        del running[job_id]
+                for vin, future in list(refreshing.items()):
+                    if future.done():
+                        state.finish_refresh(vin, future)
+                        del refreshing[vin]
+            else:
+                poll_at = poll_scheduler.take_request()
+                if poll_at is not None:
+                    state.request_poll(poll_at)
+                version = state.version()
+                if version != seen:
+                    seen, snapshots = state.load_snapshots()
+                    if snapshots:
+                        publish_snapshots(snapshots)
+                time.sleep(SYNC_INTERVAL)
+        except Exception as e:
+            logger.error('Error syncing shared state: %s', e)
+            time.sleep(SYNC_INTERVAL)
+
+
+def start_sync(start_leader, directory=SHARED_STATE_DIR):
+    os.makedirs(directory, exist_ok=True)
+    state = SharedState(os.path.join(directory, 'state.sqlite'))
+    leader_lock = LeaderLock(os.path.join(directory, 'leader.lock'))
+    # Commands and live refreshes are queued here from every worker and run by the leader
+    # only, so only the leader talks to the vehicle API
+    command_executor.queue = state
+    live_refresher.queue = state
+    climate_scheduler.fire_log = state
+    thread = Thread(
+        target=sync_worker, args=(state, leader_lock, start_leader), name='shared-state', daemon=True
+    )
+    thread.start()
+    return thread
@@ -0,0 +1,112 @@
+from datetime import date, datetime, timedelta, timezone
+from functools import lru_cache
+
+import pytz
+
+from schedule_grid import DAY_INDEX
+
+# Slots are stored as (day, 'HH:MM', timezone) in the timezone of whoever clicked them.
+# They are normalized to UTC minutes since the epoch of their occurrence in a given ISO
+# week of that timezone, so DST is applied per week. Conversions are memoized per
+# (timezone, week), rendering and scheduling are then table lookups.
+
+DAY_MINUTES = 24 * 60
+WEEK_MINUTES = 7 * DAY_MINUTES
+# 1970-01-05 00:00 UTC, the first Monday after the epoch
+EPOCH_MONDAY = 4 * DAY_MINUTES
+QUARTER = 15
+
+
+@lru_cache(maxsize=256)
+def zone(tz_name):
+    try:
+        return pytz.timezone(tz_name)
+    except Exception:
+        return pytz.UTC
+
+
+def label_minutes(time_label):
+    # 'HH:MM' -> minutes since midnight
+    return int(time_label[:2]) * 60 + int(time_label[3:])
+
+
+def iso_week(day):
+    year, week, _ = day.isocalendar()
+    return year, week
+
+
+@lru_cache(maxsize=65536)
+def local_to_utc(tz_name, year, week, day_idx, minute):
+    # UTC epoch minute of a local weekday and time in the given ISO week. Times that do not
+    # exist or occur twice around a DST change resolve like pytz' localize() does.
+    local_date = date.fromisocalendar(year, week, day_idx + 1)
+    local = datetime(local_date.year, local_date.month, local_date.day, minute // 60, minute % 60)
+    return int(zone(tz_name).localize(local).timestamp()) // 60
+
+
+def slot_utc_minute(slot, week):
+    # UTC epoch minute of a stored slot in an ISO week of its own timezone, or None
+    day_label, time_label, tz_name = slot
+    day_idx = DAY_INDEX.get(day_label)
+    if day_idx is None:
+        return None
+    return local_to_utc(tz_name, week[0], week[1], day_idx, label_minutes(time_label))
+
+
+def minute_of_week(utc_minute):
+    # Canonical UTC minute-of-week, 0 is Monday 00:00 UTC
+    return (utc_minute - EPOCH_MONDAY) % WEEK_MINUTES
+
+
+@lru_cache(maxsize=512)
+def utc_offsets(tz_name, utc_week):
+    # UTC offset in minutes of every quarter hour of a UTC week (counted from EPOCH_MONDAY)
+    tz = zone(tz_name)
+    start = (EPOCH_MONDAY + utc_week * WEEK_MINUTES) * 60
+
+    def offset(seconds):
+        instant = datetime.fromtimestamp(seconds, timezone.utc)
+        return int(instant.astimezone(tz).utcoffset().total_seconds()) // 60
+
+    quarters = WEEK_MINUTES // QUARTER
+    first = offset(start)
+    if first == offset(start + (WEEK_MINUTES - QUARTER) * 60):
+        # No DST change this week, which is nearly always the case
+        return (first,) * quarters
+    return tuple(offset(start + q * QUARTER * 60) for q in range(quarters))
+
+
+def viewer_local(utc_minute, tz_name):
+    # (weekday index, minutes since midnight) of a UTC epoch minute in a viewer's timezone
+    utc_week, minute = divmod(utc_minute - EPOCH_MONDAY, WEEK_MINUTES)
+    local = utc_minute + utc_offsets(tz_name, utc_week)[minute // QUARTER]
+    day, minute_of_day = divmod(local - EPOCH_MONDAY, DAY_MINUTES)
+    return day % 7, minute_of_day
+
+
+def project_slots(slots, viewer_tz, week):
+    # (weekday index, minutes since midnight) per slot, as seen by a viewer in the given
+    # ISO week. Slots without timezone are shown as they are.
+    cells = []
+    for slot in slots:
+        if len(slot) == 3:
+            utc_minute = slot_utc_minute(slot, week)
+            if utc_minute is not None:
+                cells.append(viewer_local(utc_minute, viewer_tz))
+        elif len(slot) == 2 and slot[0] in DAY_INDEX:
+            cells.append((DAY_INDEX[slot[0]], label_minutes(slot[1])))
+    return cells
+
+
+def next_utc_occurrence(slot, after):
+    # First start of a slot strictly after the aware datetime `after`, as an aware UTC
+    # datetime, or None for an invalid slot
+    local_day = after.astimezone(zone(slot[2])).date()
+    after_ts = after.timestamp()
+    for weeks in range(3):
+        utc_minute = slot_utc_minute(slot, iso_week(local_day + timedelta(weeks=weeks)))
+        if utc_minute is None:
+            return None
+        if utc_minute * 60 > after_ts:
+            return datetime.fromtimestamp(utc_minute * 60, pytz.UTC)
+    return None
@@ -0,0 +1,84 @@
+import dataclasses
+import json
+import logging
+import os
+import tempfile
+from datetime import datetime
+from threading import Lock
+
+import globals
+from vehicle_snapshot import VehicleSnapshot
+
+STATE_CACHE_FILE = os.getenv('STATE_CACHE_FILE', 'state_cache.json')
+
+_save_lock = Lock()
+
+# Account credentials the Token carries along. They are not written to disk, loading a
+# token takes them from the environment again.
+CREDENTIAL_FIELDS = ('username', 'password', 'pin')
+
+logger = logging.getLogger(__name__)
+
+
+def token_to_dict(token):
+    return {
+        k: v.isoformat() if isinstance(v, datetime) else v
+        for k, v in dataclasses.asdict(token).items()
+        if k not in CREDENTIAL_FIELDS
+    }
+
+
+def token_from_dict(data):
+    from hyundai_kia_connect_api import Token
+
+    fields = {f.name: f.type for f in dataclasses.fields(Token)}
+    data = {k: v for k, v in data.items() if k in fields}
+    for k, v in data.items():
+        if isinstance(v, str) and k in ('valid_until', 'control_token_expiry'):
+            data[k] = datetime.fromisoformat(v)
+    # The library logs in again with these once the token expires
+    credentials = {'username': globals.USERNAME, 'password': globals.PASSWORD, 'pin': globals.PIN}
+    data.update({k: v for k, v in credentials.items() if k in fields})
+    return Token(**data)
+
+
+def save_state():
+    # Last snapshots and the login token, so a restart can show data and skip the login
+    token = getattr(globals.vm, 'token', None)
+    state = {
+        'snapshots': {vin: snap.to_dict() for vin, snap in globals.snapshots.items()},
+        'token': token_to_dict(token) if token is not None else None,
+    }
+    directory = os.path.dirname(os.path.abspath(STATE_CACHE_FILE))
+    # Polls and live refreshes save from different threads, the last one to finish wins
+    with _save_lock:
+        # A unique temporary file, created private (the token holds credentials)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.state_cache-')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(state, f)
+            os.replace(tmp_path, STATE_CACHE_FILE)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+
+def load_state():
+    # Returns (snapshots, token) of the last run, ({}, None) if there is nothing usable
+    try:
+        with open(STATE_CACHE_FILE, 'r') as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return {}, None
+    except Exception as e:
+        logger.warning('Could not read state cache %s: %s', STATE_CACHE_FILE, e)
+        return {}, None
+    try:
+        snapshots = {
+            vin: VehicleSnapshot.from_dict(data) for vin, data in state.get('snapshots', {}).items()
+        }
+        token = token_from_dict(state['token']) if state.get('token') else None
+    except Exception as e:
+        logger.warning('Ignoring invalid state cache %s: %s', STATE_CACHE_FILE, e)
+        return {}, None
+    return snapshots, token
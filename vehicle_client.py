@@ -0,0 +1,309 @@
+import logging
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+from threading import Lock
+
+import globals
+from metrics import VENDOR_API_ERRORS, VENDOR_API_REJECTED, VENDOR_API_SECONDS, Gauge, registry
+from state_cache import load_state
+
+# 'kia' talks to Kia Connect, 'fake' simulates vehicles (see fake_vehicle_manager)
+VEHICLE_BACKEND = os.getenv('VEHICLE_BACKEND', 'kia')
+# Vendor API calls that may be in flight at the same time
+VENDOR_CONCURRENCY = int(os.getenv('VENDOR_CONCURRENCY', '2'))
+# A token that was checked this recently is reused without asking the vendor
+TOKEN_CHECK_INTERVAL = float(os.getenv('TOKEN_CHECK_INTERVAL', '300'))
+# Consecutive failures that open the circuit breaker, and its (jittered) backoff bounds
+BREAKER_THRESHOLD = int(os.getenv('BREAKER_THRESHOLD', '5'))
+BREAKER_BASE_DELAY = float(os.getenv('BREAKER_BASE_DELAY', '30'))
+BREAKER_MAX_DELAY = float(os.getenv('BREAKER_MAX_DELAY', str(30 * 60)))
+
+# Method -> (timeout in seconds, calls per minute, burst)
+ENDPOINT_LIMITS = {
+    'check_and_refresh_token': (45, 2, 2),
+    'initialize_vehicles': (45, 1, 1),
+    'update_vehicle_with_cached_state': (30, 30, 10),
+    'force_refresh_vehicle_state': (90, 2, 2),
+    'start_climate': (60, 6, 3),
+    'stop_climate': (60, 6, 3),
+    'start_charge': (60, 6, 3),
+    'stop_charge': (60, 6, 3),
+}
+
+_connect_lock = Lock()
+
+logger = logging.getLogger(__name__)
+
+
+class VendorApiUnavailable(Exception):
+    # Raised without calling the vendor while the circuit breaker is open or an endpoint
+    # is over its rate limit. retry_after is in seconds.
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class VendorApiTimeout(Exception):
+    pass
+
+
+# Errors that count against the circuit breaker whatever the backend: timeouts and
+# transport errors (requests' exceptions are OSErrors too). See vendor_failures().
+VENDOR_FAILURES = (VendorApiTimeout, OSError)
+
+
+class RateLimiter:
+    # Token bucket, refilled at `per_minute` calls per minute up to `burst` calls
+
+    def __init__(self, per_minute, burst):
+        self.rate = per_minute / 60.0
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+
+    def acquire(self, now):
+        # Takes a token and returns 0, or returns the seconds until one is available
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0
+        return (1 - self._tokens) / self.rate
+
+
+class CircuitBreaker:
+    # Opens after `threshold` consecutive failures. While open, calls are refused until
+    # the backoff expires; then a single trial call decides between closing again and
+    # reopening for twice as long. Backoffs are jittered so restarted instances spread out.
+
+    def __init__(self, threshold, base_delay, max_delay, rng=None):
+        self.threshold = threshold
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._rng = rng or random.Random()
+        self._failures = 0
+        self._trips = 0
+        self._retry_at = None
+        self._probing = False
+
+    @property
+    def is_open(self):
+        return self._retry_at is not None
+
+    def before_call(self, now):
+        # Raises VendorApiUnavailable if the call may not go ahead
+        if self._retry_at is None:
+            return
+        if now < self._retry_at:
+            raise VendorApiUnavailable('Vehicle API circuit breaker is open', self._retry_at - now)
+        if self._probing:
+            raise VendorApiUnavailable('Vehicle API circuit breaker is testing the API', 1.0)
+        self._probing = True
+
+    def record_success(self):
+        if self._retry_at is not None:
+            logger.info('Vehicle API recovered, closing the circuit breaker')
+        self._failures = 0
+        self._trips = 0
+        self._retry_at = None
+        self._probing = False
+
+    def record_failure(self, now):
+        self._failures += 1
+        if self._failures < self.threshold and not self._probing:
+            return
+        self._probing = False
+        self._trips += 1
+        delay = min(self.max_delay, self.base_delay * 2 ** (self._trips - 1))
+        # Equal jitter: between half and the full backoff
+        delay = delay / 2 + self._rng.uniform(0, delay / 2)
+        self._retry_at = now + delay
+        logger.warning(
+            'Vehicle API failed %d times in a row, pausing calls for %.0f s', self._failures, delay
+        )
+
+
+class ResilientVehicleManager:
+    # Thread-safe facade around a VehicleManager with the same method names. Calls run on
+    # a small pool, so at most `concurrency` are in flight and a hanging call only costs
+    # its caller the endpoint timeout. Endpoints are rate limited, one refreshed token is
+    # shared by every thread, and repeated failures open a circuit breaker instead of
+    # piling up retries against the vendor. Only `failures` count as such, an unknown
+    # vehicle is refused without calling the vendor at all.
+
+    def __init__(
+        self,
+        vm,
+        concurrency=VENDOR_CONCURRENCY,
+        limits=ENDPOINT_LIMITS,
+        breaker=None,
+        token_check_interval=TOKEN_CHECK_INTERVAL,
+        failures=VENDOR_FAILURES,
+    ):
+        self._vm = vm
+        self.failures = failures
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='vendor')
+        self._timeouts = {method: timeout for method, (timeout, _, _) in limits.items()}
+        self._limiters = {
+            method: RateLimiter(per_minute, burst) for method, (_, per_minute, burst) in limits.items()
+        }
+        self.breaker = breaker or CircuitBreaker(
+            BREAKER_THRESHOLD, BREAKER_BASE_DELAY, BREAKER_MAX_DELAY
+        )
+        self.token_check_interval = token_check_interval
+        self._lock = Lock()
+        self._token_lock = Lock()
+        self._token_checked_at = None
+
+    @property
+    def vehicles(self):
+        return self._vm.vehicles
+
+    @property
+    def token(self):
+        return self._vm.token
+
+    @token.setter
+    def token(self, token):
+        self._vm.token = token
+
+    def get_vehicle(self, vehicle_id):
+        return self._vm.get_vehicle(vehicle_id)
+
+    def check_and_refresh_token(self):
+        # Concurrent callers wait for one check instead of each refreshing the token
+        with self._token_lock:
+            checked_at = self._token_checked_at
+            if (
+                self._vm.vehicles
+                and checked_at is not None
+                and time.monotonic() - checked_at < self.token_check_interval
+            ):
+                return False
+            result = self._call('check_and_refresh_token')
+            self._token_checked_at = time.monotonic()
+            return result
+
+    def initialize_vehicles(self):
+        return self._call('initialize_vehicles')
+
+    def update_vehicle_with_cached_state(self, vehicle_id):
+        return self._vehicle_call('update_vehicle_with_cached_state', vehicle_id)
+
+    def force_refresh_vehicle_state(self, vehicle_id):
+        return self._vehicle_call('force_refresh_vehicle_state', vehicle_id)
+
+    def start_climate(self, vehicle_id, options=None):
+        return self._vehicle_call('start_climate', vehicle_id, options)
+
+    def stop_climate(self, vehicle_id):
+        return self._vehicle_call('stop_climate', vehicle_id)
+
+    def start_charge(self, vehicle_id):
+        return self._vehicle_call('start_charge', vehicle_id)
+
+    def stop_charge(self, vehicle_id):
+        return self._vehicle_call('stop_charge', vehicle_id)
+
+    def _vehicle_call(self, method, vehicle_id, *args):
+        # E.g. a command sent before the first poll has no vehicle id yet
+        if vehicle_id is None or vehicle_id not in self._vm.vehicles:
+            raise LookupError(f'Unknown vehicle {vehicle_id}')
+        return self._call(method, vehicle_id, *args)
+
+    def _call(self, method, *args):
+        now = time.monotonic()
+        with self._lock:
+            wait = self._limiters[method].acquire(now)
+            if wait:
+                VENDOR_API_REJECTED.inc(method=method, reason='rate_limit')
+                raise VendorApiUnavailable(f'{method} is rate limited', wait)
+            try:
+                self.breaker.before_call(now)
+            except VendorApiUnavailable:
+                VENDOR_API_REJECTED.inc(method=method, reason='circuit_open')
+                raise
+        timeout = self._timeouts[method]
+        try:
+            with VENDOR_API_SECONDS.time(errors=VENDOR_API_ERRORS, method=method):
+                future = self._executor.submit(getattr(self._vm, method), *args)
+                try:
+                    result = future.result(timeout)
+                except FutureTimeout:
+                    future.cancel()
+                    raise VendorApiTimeout(f'{method} did not finish within {timeout} s') from None
+        except self.failures:
+            with self._lock:
+                self.breaker.record_failure(time.monotonic())
+            raise
+        except Exception:
+            # The vendor did answer, the request or its response was off. Counts as a
+            # success, which also ends a trial call of the breaker.
+            with self._lock:
+                self.breaker.record_success()
+            raise
+        with self._lock:
+            self.breaker.record_success()
+        return result
+
+
+def breaker_open():
+    vm = globals.vm
+    if vm is None:
+        return {}
+    return {(): int(vm.breaker.is_open)}
+
+
+registry.register(
+    Gauge('kia_vendor_circuit_open', 'Whether calls to the vehicle API are paused', breaker_open)
+)
+
+
+def vendor_failures(backend=VEHICLE_BACKEND):
+    # VENDOR_FAILURES plus the errors the backend raises for a failing vendor API
+    if backend == 'fake':
+        from fake_vehicle_manager import FakeApiError
+
+        return VENDOR_FAILURES + (FakeApiError,)
+    from hyundai_kia_connect_api.exceptions import HyundaiKiaException
+
+    return VENDOR_FAILURES + (HyundaiKiaException,)
+
+
+def create_vehicle_manager(backend=VEHICLE_BACKEND):
+    if backend == 'fake':
+        from fake_vehicle_manager import FakeVehicleManager
+
+        return FakeVehicleManager(vins=globals.VINS)
+    if backend != 'kia':
+        raise ValueError(f'Unknown VEHICLE_BACKEND {backend!r}')
+    # The vendor library is only imported here, so the web server can start without it
+    from hyundai_kia_connect_api import VehicleManager
+
+    return VehicleManager(
+        region=1, brand=1, username=globals.USERNAME, password=globals.PASSWORD, pin=globals.PIN
+    )
+
+
+def vehicle_manager():
+    # The process wide ResilientVehicleManager, created on first use. A token cached by an
+    # earlier run (or by the leader process) saves logging in again.
+    vm = globals.vm
+    if vm is not None and vm.vehicles:
+        return vm
+    with _connect_lock:
+        if globals.vm is None:
+            vm = ResilientVehicleManager(create_vehicle_manager(), failures=vendor_failures())
+            _, token = load_state()
+            if token is not None:
+                vm.token = token
+            globals.vm = vm
+        vm = globals.vm
+        if not vm.vehicles:
+            # Commands need the vehicle list, this logs in first when there is no token
+            vm.check_and_refresh_token()
+    return vm
@@ -0,0 +1,133 @@
+from datetime import datetime
+from threading import Condition
+
+
+class VehicleSnapshot:
+    # Immutable view of one vehicle poll. The updater builds a new instance per poll and
+    # publishes it with a single reference swap, so readers always see consistent values.
+    __slots__ = (
+        'vehicle_id',
+        'vin',
+        'name',
+        'last_updated_at',
+        'battery_soc',
+        'battery_soh',
+        'battery_12v_soc',
+        'battery_range',
+        'is_plugged_in',
+        'is_charging',
+        'mileage',
+        'airco_status',
+        'outside_temp',
+        'latitude',
+        'longitude',
+    )
+
+    def __init__(
+        self,
+        vehicle_id=None,
+        vin=None,
+        name=None,
+        last_updated_at=None,
+        battery_soc=99.0,
+        battery_soh=0.0,
+        battery_12v_soc=99.0,
+        battery_range=999.0,
+        is_plugged_in=False,
+        is_charging=False,
+        mileage=0,
+        airco_status=False,
+        outside_temp=0.0,
+        latitude=51.0,
+        longitude=5.5,
+    ):
+        init = object.__setattr__
+        init(self, 'vehicle_id', vehicle_id)
+        init(self, 'vin', vin)
+        init(self, 'name', name)
+        init(self, 'last_updated_at', last_updated_at)
+        init(self, 'battery_soc', battery_soc)
+        init(self, 'battery_soh', battery_soh)
+        init(self, 'battery_12v_soc', battery_12v_soc)
+        init(self, 'battery_range', battery_range)
+        init(self, 'is_plugged_in', is_plugged_in)
+        init(self, 'is_charging', is_charging)
+        init(self, 'mileage', mileage)
+        init(self, 'airco_status', airco_status)
+        init(self, 'outside_temp', outside_temp)
+        init(self, 'latitude', latitude)
+        init(self, 'longitude', longitude)
+
+    @classmethod
+    def from_vehicle(cls, car):
+        return cls(
+            vehicle_id=car.id,
+            vin=car.VIN,
+            name=car.name,
+            last_updated_at=car.last_updated_at,
+            battery_soc=car.ev_battery_percentage,
+            battery_soh=car.ev_battery_soh_percentage,
+            battery_12v_soc=car.car_battery_percentage,
+            battery_range=car.ev_driving_range,
+            is_plugged_in=bool(car.ev_battery_is_plugged_in),
+            is_charging=bool(car.ev_battery_is_charging),
+            mileage=car.odometer,
+            airco_status=bool(car.air_control_is_on),
+            outside_temp=car.air_temperature,
+            latitude=car.location_latitude,
+            longitude=car.location_longitude,
+        )
+
+    def to_dict(self):
+        data = {s: getattr(self, s) for s in self.__slots__}
+        if self.last_updated_at is not None:
+            data['last_updated_at'] = self.last_updated_at.isoformat()
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        data = {s: data[s] for s in cls.__slots__ if s in data}
+        if data.get('last_updated_at') is not None:
+            data['last_updated_at'] = datetime.fromisoformat(data['last_updated_at'])
+        return cls(**data)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f'{type(self).__name__} is immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError(f'{type(self).__name__} is immutable')
+
+    def __eq__(self, other):
+        if not isinstance(other, VehicleSnapshot):
+            return NotImplemented
+        return all(getattr(self, s) == getattr(other, s) for s in self.__slots__)
+
+    def __hash__(self):
+        return hash(tuple(getattr(self, s) for s in self.__slots__))
+
+    def __repr__(self):
+        fields = ', '.join(f'{s}={getattr(self, s)!r}' for s in self.__slots__)
+        return f'{type(self).__name__}({fields})'
+
+
+class SnapshotBroadcaster:
+    # Lets any number of readers block until new snapshots are published. Readers keep
+    # the last version they saw, there are no per-reader queues.
+
+    def __init__(self):
+        self._cond = Condition()
+        self.version = 0
+
+    def publish(self):
+        with self._cond:
+            self.version += 1
+            self._cond.notify_all()
+
+    def wait(self, version, timeout=None):
+        # Returns the current version, which equals `version` if the timeout expired
+        with self._cond:
+            self._cond.wait_for(lambda: self.version != version, timeout)
+            return self.version
+
+
+snapshot_broadcaster = SnapshotBroadcaster()
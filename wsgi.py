@@ -0,0 +1,27 @@
+# Production entry point, e.g. `gunicorn -c gunicorn.conf.py wsgi:application`.
+# Every worker process imports this module. One of them gets elected leader and runs the
+# updater and scheduler, the others mirror its snapshots through shared_state.
+
+import logging
+
+from KIA_Dashboard import server, start_background_threads
+from metrics import METRICS_PORT, serve_metrics
+from shared_state import start_sync
+
+logger = logging.getLogger(__name__)
+
+
+def start_leader():
+    start_background_threads()
+    # /metrics of the web port answers from whichever worker gets the request, scrape
+    # this port for the leader's polls, vendor calls and scheduler
+    if METRICS_PORT:
+        try:
+            serve_metrics(METRICS_PORT)
+        except OSError as e:
+            logger.error('Could not serve metrics on port %d: %s', METRICS_PORT, e)
+
+
+start_sync(start_leader)
+
+application = server